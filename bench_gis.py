@@ -0,0 +1,281 @@
+import os, re, sys, json, time, random, argparse, tempfile, threading, urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, List, Dict, Any
+import pandas as pd
+import scrape_gis as gis
+CITY = "tashkent"
+MONTHS = ["января", "февраля", "марта", "апреля", "мая", "июня",
+          "июля", "августа", "сентября", "октября", "ноября", "декабря"]
+PAGE_HTML = """<!doctype html>
+<html lang="ru"><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ margin: 0; font-family: sans-serif; }}
+#list {{ height: 760px; width: 640px; overflow-y: auto; }}
+._card {{ padding: 12px; border-bottom: 1px solid #ddd; min-height: 90px; }}
+._1fkin5c {{ height: 10px; background: #fc0; }}
+</style></head><body>
+<a href="/{city}/firm/{fid}/tab/reviews">Отзывы {total}</a>
+<div id="list"><div id="items"></div><button id="more" style="display:none">Ещё отзывы</button></div>
+<script>
+const FID = "{fid}", TOTAL = {total}, PAGE = {page}, DELAY = {delay}, WINDOW = {window};
+const MONTHS = {months};
+const list = document.getElementById('list'), items = document.getElementById('items'), more = document.getElementById('more');
+let offset = 0, loading = false;
+function ruDate(iso) {{
+  const d = new Date(iso);
+  return d.getUTCDate() + ' ' + MONTHS[d.getUTCMonth()] + ' ' + d.getUTCFullYear();
+}}
+function render(reviews) {{
+  for (const r of reviews) {{
+    const card = document.createElement('div');
+    card.className = '_card';
+    card.innerHTML =
+      '<span class="_16s5yj36" title="' + r.user.name + '">' + r.user.name + '</span> ' +
+      '<span class="_89b5km">' + r.user.reviews_count + ' отзывов</span>' +
+      '<div class="_a5f6uz">' + ruDate(r.date_created) + '</div>' +
+      '<div class="_1fkin5c" style="width:' + (r.rating * 10) + 'px"></div>' +
+      '<a class="_1msln3t" href="' + r.url + '">' + r.text + '</a>';
+    items.appendChild(card);
+  }}
+  if (WINDOW > 0) {{
+    while (items.children.length > WINDOW) items.removeChild(items.firstChild);
+  }}
+}}
+async function loadMore() {{
+  if (loading || offset >= TOTAL) return;
+  loading = true;
+  await new Promise(res => setTimeout(res, DELAY));
+  const resp = await fetch('/2.0/branches/' + FID + '/reviews?limit=' + PAGE + '&offset=' + offset + '&key=bench&locale=ru_RU');
+  const data = await resp.json();
+  render(data.reviews);
+  offset += data.reviews.length;
+  loading = false;
+  more.style.display = offset < TOTAL ? 'block' : 'none';
+}}
+list.addEventListener('scroll', () => {{
+  if (list.scrollTop + list.clientHeight >= list.scrollHeight - 60) loadMore();
+}});
+more.addEventListener('click', loadMore);
+loadMore();
+</script></body></html>"""
+SEARCH_HTML = """<!doctype html>
+<html lang="ru"><head><meta charset="utf-8"><title>Поиск: {q}</title></head><body>
+{links}
+</body></html>"""
+class FakeGis:
+    def __init__(self, n_firms: int, min_reviews: int, max_reviews: int, page: int, delay_ms: int,
+                 window: int, noise: int, seed: int):
+        rnd = random.Random(seed)
+        self.page, self.delay_ms, self.window, self.noise = page, delay_ms, window, noise
+        self.firms: List[Dict[str, Any]] = []
+        for k in range(n_firms):
+            fid = str(70000001000000000 + k * 7919)
+            phone = f"+998 9{rnd.randint(0, 9)} {rnd.randint(100, 999)} {rnd.randint(10, 99)} {rnd.randint(10, 99)}"
+            self.firms.append({
+                "fid": fid, "name": f"Ресторан {k} {rnd.choice(['Самарканд', 'Плов', 'Чайхона', 'Лагман'])}",
+                "phone": phone, "lat": 41.3 + rnd.random() / 10, "lon": 69.2 + rnd.random() / 10,
+                "total": rnd.randint(min_reviews, max_reviews),
+            })
+        self.by_id = {f["fid"]: f for f in self.firms}
+        self.lock = threading.Lock()
+        self.html_loads = 0
+        self.api_calls = 0
+        self.server: Optional[ThreadingHTTPServer] = None
+    def reviews(self, firm: Dict[str, Any], offset: int, limit: int) -> List[Dict[str, Any]]:
+        out = []
+        base = time.mktime((2024, 6, 1, 12, 0, 0, 0, 0, -1))
+        for n in range(offset, min(offset + limit, firm["total"])):
+            ts = base - n * 86400 * 3
+            out.append({
+                "id": f"{firm['fid']}-{n}",
+                "text": f"Отзыв {n} о заведении «{firm['name']}»: плов отличный, обслуживание {['быстрое', 'медленное', 'нормальное'][n % 3]}.",
+                "rating": 1 + (n * 7) % 5,
+                "date_created": time.strftime("%Y-%m-%dT%H:%M:%S+05:00", time.gmtime(ts)),
+                "url": f"/{CITY}/reviews/{firm['fid']}/{n}",
+                "likes_count": n % 4,
+                "user": {"name": f"Гость {n % 37}", "reviews_count": 1 + n % 11, "url": f"/{CITY}/user/{n % 37}"},
+                "photos": [{"preview_urls": {"url": f"/photo/{firm['fid']}/{n}.jpg"}}] if n % 5 == 0 else [],
+                "official_answer": {"text": "Спасибо за отзыв!", "date_created": "2024-06-02T10:00:00+05:00"} if n % 6 == 0 else None,
+            })
+        return out
+    def search(self, q: str) -> List[str]:
+        qd = re.sub(r"\D+", "", q)
+        hits = []
+        for f in self.firms:
+            if q.lower() in f["name"].lower() or (len(qd) >= 7 and re.sub(r"\D+", "", f["phone"]).endswith(qd)):
+                hits.append(f["fid"])
+        if hits and self.noise:
+            rnd = random.Random(q)
+            hits += [f["fid"] for f in rnd.sample(self.firms, min(self.noise, len(self.firms)))]
+        return list(dict.fromkeys(hits))
+    def start(self) -> str:
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+            def send(self, code: int, body: str, ctype: str = "text/html; charset=utf-8", headers: Optional[Dict[str, str]] = None):
+                data = body.encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+            def do_GET(self):
+                parts = urllib.parse.urlsplit(self.path)
+                path = urllib.parse.unquote(parts.path)
+                m = re.match(r"^/2\.0/branches/(\d+)/reviews$", path)
+                if m:
+                    with fake.lock: fake.api_calls += 1
+                    firm = fake.by_id.get(m.group(1))
+                    if not firm:
+                        return self.send(404, "{}", "application/json")
+                    q = dict(urllib.parse.parse_qsl(parts.query))
+                    offset, limit = int(q.get("offset", 0)), min(int(q.get("limit", 12)), 50)
+                    revs = fake.reviews(firm, offset, limit)
+                    nxt = None
+                    if offset + len(revs) < firm["total"]:
+                        nq = dict(q, offset=str(offset + len(revs)), limit=str(limit))
+                        nxt = f"http://{self.headers.get('Host')}{parts.path}?{urllib.parse.urlencode(nq)}"
+                    body = {"meta": {"code": 200, "total_count": firm["total"], "next_link": nxt}, "reviews": revs}
+                    return self.send(200, json.dumps(body, ensure_ascii=False), "application/json; charset=utf-8")
+                if path.startswith("/photo/") or path == "/favicon.ico":
+                    return self.send(404, "")
+                with fake.lock: fake.html_loads += 1
+                m = re.match(rf"^/{CITY}/search/(.+)$", path)
+                if m:
+                    q = m.group(1)
+                    links = "\n".join(f'<a href="/{CITY}/firm/{fid}">{fake.by_id[fid]["name"]}</a>' for fid in fake.search(q))
+                    return self.send(200, SEARCH_HTML.format(q=q, links=links))
+                m = re.match(rf"^/{CITY}/(?:firm|branch)/(\d+)(?:/tab/reviews|/reviews)?/?$", path)
+                if m:
+                    firm = fake.by_id.get(m.group(1))
+                    if not firm:
+                        return self.send(302, "", headers={"Location": f"/{CITY}"})
+                    return self.send(200, PAGE_HTML.format(
+                        title=firm["name"], city=CITY, fid=firm["fid"], total=firm["total"], page=fake.page,
+                        delay=fake.delay_ms, window=fake.window, months=json.dumps(MONTHS, ensure_ascii=False)))
+                return self.send(200, f"<html><head><title>2ГИС</title></head><body>{CITY}</body></html>")
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name="fake-2gis", daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+def write_input(fake: FakeGis, path: str):
+    rows = [{"id": f"{f['fid']}_{70000000000 + k}", "name": f["name"], "phones": f["phone"],
+             "lat": f["lat"], "lon": f["lon"]} for k, f in enumerate(fake.firms)]
+    pd.DataFrame(rows).to_excel(path, index=False)
+def run_bench(args) -> Dict[str, Any]:
+    fake = FakeGis(args.firms, args.min_reviews, args.max_reviews, args.page, args.delay_ms,
+                   args.window, args.noise, args.seed)
+    base = fake.start()
+    work = tempfile.mkdtemp(prefix="bench-2gis-")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work)
+        write_input(fake, "input.xlsx")
+        gis.EXCEL_PATH = "input.xlsx"
+        gis.BASE_DOMAIN = base
+        gis.CITY_SLUG = CITY
+        gis.OUT_PROGRESS = "progress.csv"
+        gis.OUT_DIR = "out"
+        gis.OUT_PARQUET = None
+        gis.JOURNAL_PATH = "journal.jsonl"
+        gis.RESUME = False
+        gis.INCREMENTAL = False
+        gis.RESOLVE_CACHE_DB = None
+        gis.REVIEW_INDEX_DB = None
+        gis.PROFILE_DIR = os.path.join(work, "chrome-profile")
+        gis.HEADLESS = args.headless
+        gis.WORKERS = args.workers
+        gis.REQUESTS_PER_MIN = args.requests_per_min
+        gis.VERBOSE = args.verbose
+        gis.REVIEWS_ENGINE = "api" if args.engine == "api" else "dom"
+        gis.CAPTURE_NETWORK = args.engine in ("api", "capture")
+        t0 = time.time()
+        gis.main()
+        elapsed = time.time() - t0
+        df = pd.read_csv(gis.OUT_PROGRESS, dtype=str)
+    finally:
+        os.chdir(cwd)
+        fake.stop()
+    df["card_id"] = df["two_gis_url"].fillna("").map(lambda u: gis.card_id_from_url(u) or "")
+    got = df[df["review_text"].notna()]
+    per_card = []
+    for f in fake.firms:
+        uniq = got.loc[got["card_id"] == f["fid"], "review_text"].nunique()
+        per_card.append({"fid": f["fid"], "total": f["total"], "collected": int(uniq)})
+    total = sum(c["total"] for c in per_card)
+    collected = sum(min(c["collected"], c["total"]) for c in per_card)
+    cards = got["two_gis_url"].nunique()
+    return {
+        "engine": args.engine, "firms": args.firms, "workers": args.workers, "seed": args.seed,
+        "elapsed_sec": round(elapsed, 2),
+        "cards_per_min": round(cards / elapsed * 60, 2) if elapsed else 0.0,
+        "reviews_per_sec": round(len(got) / elapsed, 3) if elapsed else 0.0,
+        "page_loads": fake.html_loads,
+        "page_loads_per_row": round(fake.html_loads / max(1, args.firms), 2),
+        "api_calls": fake.api_calls,
+        "reviews_expected": total,
+        "reviews_collected": collected,
+        "duplicate_rows": int(len(got) - got.drop_duplicates(["card_id", "review_text"]).shape[0]),
+        "recall": round(collected / total, 4) if total else 1.0,
+        "per_card": per_card,
+    }
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарк парсера 2ГИС на локальном фейковом сервере")
+    ap.add_argument("--firms", type=int, default=12)
+    ap.add_argument("--min-reviews", type=int, default=0)
+    ap.add_argument("--max-reviews", type=int, default=150)
+    ap.add_argument("--page", type=int, default=12, help="отзывов за одну подгрузку")
+    ap.add_argument("--delay-ms", type=int, default=250, help="задержка ленивой подгрузки")
+    ap.add_argument("--window", type=int, default=0, help="сколько карточек держать в DOM (0 — все)")
+    ap.add_argument("--noise", type=int, default=2, help="лишних карточек в выдаче поиска")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--engine", choices=["api", "capture", "dom"], default="api")
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--requests-per-min", type=float, default=600)
+    ap.add_argument("--headless", action="store_true")
+    ap.add_argument("--verbose", action="store_true")
+    ap.add_argument("--json", help="куда сохранить результат")
+    ap.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    ap.add_argument("--save-baseline", help="сохранить результат как новый baseline")
+    ap.add_argument("--tolerance", type=float, default=0.15, help="допустимое ухудшение скорости (доля)")
+    ap.add_argument("--require-baseline", action="store_true", help="без файла --baseline завершиться с ошибкой (для CI)")
+    args = ap.parse_args()
+    baseline = None
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+        else:
+            msg = f"Baseline {args.baseline} не найден — регрессии по скорости и recall НЕ проверяются"
+            if os.environ.get("GITHUB_ACTIONS"):
+                print(f"::{'error' if args.require_baseline else 'warning'}::{msg}")
+            print(f"!! {msg}", file=sys.stderr)
+            if args.require_baseline:
+                return 2
+    result = run_bench(args)
+    summary = {k: v for k, v in result.items() if k != "per_card"}
+    print("\n=== Бенчмарк ===")
+    for k, v in summary.items():
+        print(f"  {k:20s} {v}")
+    for path in (args.json, args.save_baseline):
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+    if baseline is not None:
+        problems = gis.compare_report(result, baseline, args.tolerance,
+                                      higher=("reviews_per_sec", "cards_per_min"), lower=("page_loads_per_row",))
+        if problems:
+            print("РЕГРЕССИЯ:")
+            for p in problems:
+                print(f"  {p}")
+            return 1
+        print("Регрессий нет")
+    return 0
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,210 @@
-import os, re, time, random, hashlib, tempfile, urllib.parse
-from typing import Optional, List, Dict, Any, Tuple
-import pandas as pd
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.common.action_chains import ActionChains
-from selenium.common.exceptions import (
-    NoSuchElementException, TimeoutException, WebDriverException, SessionNotCreatedException
-)
-from webdriver_manager.chrome import ChromeDriverManager
+from __future__ import annotations
+import os, re, sys, csv, gzip, time, json, zlib, base64, random, shutil, socket, hashlib, sqlite3, argparse, tempfile, functools, importlib, urllib.parse, threading, queue
+from contextlib import contextmanager
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, List, Dict, Any, Tuple, Iterator, Callable
+class LazyImport:
+    def __init__(self, module: str, attr: Optional[str] = None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            self._target = getattr(target, self._attr) if self._attr else target
+        return self._target
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+pd = LazyImport("pandas")
+requests = LazyImport("requests")
+HTTPAdapter = LazyImport("requests.adapters", "HTTPAdapter")
+Retry = LazyImport("urllib3.util.retry", "Retry")
+webdriver = LazyImport("selenium.webdriver")
+Service = LazyImport("selenium.webdriver.chrome.service", "Service")
+Options = LazyImport("selenium.webdriver.chrome.options", "Options")
+By = LazyImport("selenium.webdriver.common.by", "By")
+Keys = LazyImport("selenium.webdriver.common.keys", "Keys")
+ActionChains = LazyImport("selenium.webdriver.common.action_chains", "ActionChains")
+selenium_errors = LazyImport("selenium.common.exceptions")
 EXCEL_PATH  = "Ташкент_рестораны.xlsx"
 CITY_SLUG   = "tashkent"
 BASE_DOMAIN = "https://2gis.uz"
+INPUTS: List[Tuple[str, str]] = []
+SHARD: Optional[Tuple[int, int]] = None
+ROW_RANGE: Optional[Tuple[int, Optional[int]]] = None
 OUT_PROGRESS = "2gis_reviews_progress.csv"
 OUT_DIR      = "out"
+OUT_PARQUET  = None
+OUT_CLEAN    = "2gis_reviews_clean.csv"
+POSTPROCESS  = True
+JOURNAL_PATH = "2gis_journal.jsonl"
+RESUME       = False
+JOB_QUEUE_DB = "2gis_jobs.sqlite"
+JOB_VISIBILITY_TIMEOUT = 900
+JOB_MAX_ATTEMPTS       = 3
+JOB_POLL_INTERVAL      = 5.0
 CHUNK_SIZE   = 20
 REQUESTS_PER_MIN       = 8
+DOMAIN_REQUESTS_PER_MIN: Dict[str, float] = {}
+DOMAIN_BURST           = 1
 MAX_LOAD_STEPS         = 150
 STAGNATION_ROUNDS      = 3
 PER_CARD_HARD_TIMEOUT  = 200
+SMALL_CARD_REVIEWS     = 12
+HUGE_CARD_REVIEWS      = 500
+HUGE_CARD_TIMEOUT      = 900
+REVIEWS_PER_STEP       = 8
+SECONDS_PER_REVIEW     = 0.5
+SIZE_ORDER             = True
+SIZE_ORDER_WINDOW      = 200
+TIME_BUDGET_MIN: Optional[float] = None
 WAIT_SMALL             = 0.5
+GROWTH_WAIT_TIMEOUT    = 3.0
+RECYCLE_AFTER_CARDS    = 150
+RENDERER_MEM_LIMIT_MB  = 2500
 HEADLESS               = False
 PROFILE_DIR            = os.path.abspath("./chrome-profile-2gis")
+CHROMEDRIVER_PATH      = None
+DRIVER_CACHE_PATH      = "2gis_chromedriver.json"
+DEBUGGER_ADDRESS       = None
+TEMP_PROFILE_MAX_AGE_H = 24
 PAGELOAD_STRATEGY      = "eager"
+LIGHT_MODE             = True
+BLOCKED_URL_PATTERNS   = [
+    "*.png*", "*.jpg*", "*.jpeg*", "*.gif*", "*.webp*", "*.avif*", "*.svg*", "*.ico*",
+    "*.woff*", "*.ttf*", "*.otf*", "*.mp4*", "*.webm*",
+    "*tile*.maps.2gis.com*", "*traffic*.maps.2gis.com*", "*.2gis.com/tiles*",
+    "*mc.yandex.ru*", "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*",
+    "*top-fwz1.mail.ru*", "*connect.facebook.net*", "*stat.2gis.com*",
+]
 VERBOSE                = True
+RETRY_BELOW_RECALL     = 0.9
+RETRY_WAIT_FACTOR      = 2.0
+DEBUG_DIR              = "debug"
+DEBUG_SAMPLE_RATE      = 0.1
+DEBUG_MAX_FILES        = 50
+METRICS_PATH           = "2gis_metrics.jsonl"
+REPORT_PATH            = "2gis_reports.jsonl"
+REPORT_BASELINE        = "2gis_report_baseline.json"
+REPORT_TOLERANCE       = 0.15
+METRICS_PORT           = None
+WORKERS                = 1
+REVIEWS_ENGINE         = "api"
+REVIEWS_API_RX         = r"/branches/\d+/reviews\?"
+API_PAGE_LIMIT         = 50
+API_MAX_PAGES          = 200
+API_TIMEOUT            = 15
+CAPTURE_NETWORK        = True
+RESOLVE_CACHE_DB       = "2gis_cache.sqlite"
+RESOLVE_CACHE_TTL_DAYS = 30
+EMPTY_SEARCH_TTL_H     = 6
+MAX_WEAK_CANDIDATES    = 2
+INCREMENTAL            = False
+REVIEW_INDEX_DB        = "2gis_cache.sqlite"
+CARD_INDEX_MAX_AGE_H   = 24
 def log(msg: str):
     if VERBOSE:
         print(msg, flush=True)
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+        self.run_id = time.strftime("%Y%m%d-%H%M%S")
+        self.started = time.time()
+        self.f = None
+    def open(self, path: Optional[str]):
+        if path:
+            self.f = open(path, "a", encoding="utf-8")
+    def emit(self, rec: Dict[str, Any]):
+        if self.f is None: return
+        rec = {"run": self.run_id, "ts": round(time.time(), 3), **rec}
+        self.f.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+    def observe(self, stage: str, seconds: float, **extra):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(seconds)
+            self.emit({"stage": stage, "sec": round(seconds, 4), "thread": threading.current_thread().name, **extra})
+    def inc(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    @contextmanager
+    def timed(self, stage: str, **extra):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0, **extra)
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        def pct(xs: List[float], q: float) -> float:
+            return xs[min(len(xs) - 1, int(round(q * (len(xs) - 1))))]
+        out = {}
+        with self.lock:
+            for stage, xs in self.timings.items():
+                xs = sorted(xs)
+                out[stage] = {"count": len(xs), "p50": round(pct(xs, 0.5), 3), "p95": round(pct(xs, 0.95), 3),
+                              "total": round(sum(xs), 2)}
+        return out
+    def prometheus_text(self) -> str:
+        lines = ["# TYPE gis_stage_seconds summary"]
+        for stage, st in sorted(self.summary().items()):
+            lines.append(f'gis_stage_seconds{{stage="{stage}",quantile="0.5"}} {st["p50"]}')
+            lines.append(f'gis_stage_seconds{{stage="{stage}",quantile="0.95"}} {st["p95"]}')
+            lines.append(f'gis_stage_seconds_sum{{stage="{stage}"}} {st["total"]}')
+            lines.append(f'gis_stage_seconds_count{{stage="{stage}"}} {st["count"]}')
+        with self.lock:
+            counters = dict(self.counters)
+        for name, v in sorted(counters.items()):
+            lines.append(f"# TYPE gis_{name}_total counter")
+            lines.append(f"gis_{name}_total {v}")
+        return "\n".join(lines) + "\n"
+    def serve(self, port: int):
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+            def do_GET(self):
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200 if self.path.startswith("/metrics") else 404)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        srv = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        threading.Thread(target=srv.serve_forever, name="metrics-http", daemon=True).start()
+        log(f"Метрики Prometheus: http://localhost:{port}/metrics")
+    def report(self):
+        summary = self.summary()
+        with self.lock:
+            self.emit({"t": "summary", "stages": summary, "counters": self.counters,
+                       "elapsed": round(time.time() - self.started, 1)})
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+        if not summary: return
+        print("\n=== Время по этапам (сек) ===")
+        print(f"{'этап':28s} {'n':>7s} {'p50':>8s} {'p95':>8s} {'всего':>10s}")
+        for stage, st in sorted(summary.items(), key=lambda kv: -kv[1]["total"]):
+            print(f"{stage:28s} {st['count']:7d} {st['p50']:8.3f} {st['p95']:8.3f} {st['total']:10.1f}")
+        for name, v in sorted(self.counters.items()):
+            print(f"{name:28s} {v:g}")
+METRICS = Metrics()
+def timed(stage: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with METRICS.timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+def pause(seconds: float, reason: str = "misc"):
+    if seconds <= 0: return
+    METRICS.observe(f"sleep:{reason}", seconds)
+    time.sleep(seconds)
+def run_js(driver, name: str, script: str, *args):
+    with METRICS.timed(f"js:{name}"):
+        return driver.execute_script(script, *args)
 def norm(s: Optional[str]) -> Optional[str]:
     if s is None: return None
     return re.sub(r"\s+", " ", str(s)).strip()
@@ -54,10 +230,10 @@ def phone_variants(raw: str) -> List[str]:
         if v and v not in seen:
             seen.add(v); out.append(v)
     return out
-def pick_col(df: pd.DataFrame, candidates: List[str]) -> Optional[str]:
+def pick_col(columns: List[str], candidates: List[str]) -> Optional[str]:
     for c in candidates:
-        if c in df.columns: return c
-    low = {c.lower(): c for c in df.columns}
+        if c in columns: return c
+    low = {c.lower(): c for c in columns}
     for cand in candidates:
         if cand.lower() in low: return low[cand.lower()]
     return None
@@ -65,10 +241,19 @@ def id_prefix_from_full(full_id: Optional[str]) -> Optional[str]:
     if not full_id: return None
     s = str(full_id).strip()
     return s.split("_", 1)[0] if "_" in s else s
-def firm_url(fid: str)  -> str: return f"{BASE_DOMAIN}/{CITY_SLUG}/firm/{fid}"
-def branch_url(fid: str)-> str: return f"{BASE_DOMAIN}/{CITY_SLUG}/branch/{fid}"
-def search_url(q: str, lon: Optional[float]=None, lat: Optional[float]=None) -> str:
-    base = f"{BASE_DOMAIN}/{CITY_SLUG}/search/{urllib.parse.quote(q)}"
+def default_site() -> str: return f"{BASE_DOMAIN}/{CITY_SLUG}"
+def site_domain(site: str) -> str: return urllib.parse.urlsplit(site).netloc
+def site_origin(url: str) -> str:
+    p = urllib.parse.urlsplit(url)
+    return f"{p.scheme}://{p.netloc}"
+def firm_url(fid: str, site: Optional[str] = None)  -> str: return f"{site or default_site()}/firm/{fid}"
+def branch_url(fid: str, site: Optional[str] = None)-> str: return f"{site or default_site()}/branch/{fid}"
+def reviews_tab_url(u: str) -> str: return u.rstrip("/") + "/tab/reviews"
+def card_base_url(u: Optional[str]) -> Optional[str]:
+    m = re.search(r"^(https?://[^/]+/[^/]+/(?:firm|branch)/\d+)", u or "")
+    return m.group(1) if m else None
+def search_url(q: str, lon: Optional[float]=None, lat: Optional[float]=None, site: Optional[str] = None) -> str:
+    base = f"{site or default_site()}/search/{urllib.parse.quote(q)}"
     if lon is not None and lat is not None:
         return f"{base}?m={lon}%2C{lat}%2F12"
     return base
@@ -86,41 +271,175 @@ def build_options(user_data_dir: Optional[str]) -> Options:
     opts.add_experimental_option("excludeSwitches", ["enable-automation"])
     opts.add_experimental_option("useAutomationExtension", False)
     opts.page_load_strategy = PAGELOAD_STRATEGY
+    if LIGHT_MODE:
+        opts.add_argument("--blink-settings=imagesEnabled=false")
+        opts.add_experimental_option("prefs", {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.managed_default_content_settings.media_stream": 2,
+            "profile.default_content_setting_values.notifications": 2,
+            "profile.default_content_setting_values.geolocation": 2,
+        })
+    if CAPTURE_NETWORK:
+        opts.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        opts.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
     if user_data_dir:
         os.makedirs(user_data_dir, exist_ok=True)
         opts.add_argument(f"--user-data-dir={user_data_dir}")
     return opts
-def start_chrome_with_fallback() -> webdriver.Chrome:
+def apply_resource_blocking(driver):
+    if not LIGHT_MODE: return
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+    except Exception as e:
+        log(f"!! Не удалось включить блокировку ресурсов: {e}")
+_driver_path: Optional[str] = None
+_driver_lock = threading.Lock()
+def chromedriver_path(refresh: bool = False) -> str:
+    global _driver_path
+    if CHROMEDRIVER_PATH: return CHROMEDRIVER_PATH
+    with _driver_lock:
+        if _driver_path and not refresh:
+            return _driver_path
+        if not refresh:
+            try:
+                with open(DRIVER_CACHE_PATH, encoding="utf-8") as f:
+                    path = json.load(f).get("path")
+                if path and os.path.exists(path):
+                    _driver_path = path
+                    return path
+            except (OSError, ValueError):
+                pass
+        from webdriver_manager.chrome import ChromeDriverManager
+        with METRICS.timed("driver_install"):
+            path = ChromeDriverManager().install()
+        with open(DRIVER_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump({"path": path, "ts": time.time()}, f)
+        log(f"chromedriver: {path} (сохранён в {DRIVER_CACHE_PATH})")
+        _driver_path = path
+        return path
+def new_chrome(opts: Options) -> webdriver.Chrome:
+    try:
+        return webdriver.Chrome(service=Service(chromedriver_path()), options=opts)
+    except selenium_errors.SessionNotCreatedException as e:
+        if CHROMEDRIVER_PATH or "only supports chrome version" not in str(e).lower():
+            raise
+        log("!! chromedriver не подходит к версии Chrome — обновляем")
+        return webdriver.Chrome(service=Service(chromedriver_path(refresh=True)), options=opts)
+def debugger_alive(addr: str) -> bool:
+    host, _, port = addr.rpartition(":")
+    try:
+        with socket.create_connection((host or "127.0.0.1", int(port)), timeout=0.5):
+            return True
+    except (OSError, ValueError):
+        return False
+def attach_options(addr: str) -> Options:
+    opts = Options()
+    opts.debugger_address = addr
+    opts.page_load_strategy = PAGELOAD_STRATEGY
+    if CAPTURE_NETWORK:
+        opts.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    return opts
+def fallback_profile_dir(profile_dir: str) -> str:
+    tag = hashlib.md5(os.path.abspath(profile_dir).encode("utf-8")).hexdigest()[:8]
+    return os.path.join(tempfile.gettempdir(), f"chrome-2gis-{tag}")
+def cleanup_temp_profiles():
+    root = tempfile.gettempdir()
+    cutoff = time.time() - TEMP_PROFILE_MAX_AGE_H * 3600
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if not name.startswith("chrome-2gis-"): continue
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                log(f"Удалён старый временный профиль: {path}")
+        except OSError:
+            pass
+@timed("browser_start")
+def attach_chrome() -> Optional[webdriver.Chrome]:
+    if not (DEBUGGER_ADDRESS and debugger_alive(DEBUGGER_ADDRESS)):
+        return None
+    try:
+        drv = new_chrome(attach_options(DEBUGGER_ADDRESS))
+    except selenium_errors.WebDriverException as e:
+        log(f"!! Не удалось подключиться к {DEBUGGER_ADDRESS}: {e}")
+        return None
+    log(f"Подключились к запущенному Chrome: {DEBUGGER_ADDRESS}")
+    apply_resource_blocking(drv)
+    return drv
+@timed("browser_start")
+def start_chrome_with_fallback(profile_dir: Optional[str] = None) -> webdriver.Chrome:
     try:
-        service = Service(ChromeDriverManager().install())
-        opts = build_options(PROFILE_DIR)
-        drv = webdriver.Chrome(service=service, options=opts)
+        drv = new_chrome(build_options(profile_dir or PROFILE_DIR))
+        apply_resource_blocking(drv)
         return drv
-    except (SessionNotCreatedException, WebDriverException) as e:
+    except (selenium_errors.SessionNotCreatedException, selenium_errors.WebDriverException) as e:
         log(f"!! Chrome с постоянным профилем не стартанул: {e}")
-    tmp_dir = tempfile.mkdtemp(prefix="chrome-2gis-")
+    tmp_dir = fallback_profile_dir(profile_dir or PROFILE_DIR)
     log(f"Повторный запуск с временным профилем: {tmp_dir}")
-    service = Service(ChromeDriverManager().install())
-    opts = build_options(tmp_dir)
-    drv = webdriver.Chrome(service=service, options=opts)
+    drv = new_chrome(build_options(tmp_dir))
+    apply_resource_blocking(drv)
     return drv
+def worker_profile_dir(wid: int) -> str:
+    return PROFILE_DIR if wid == 0 else f"{PROFILE_DIR}-w{wid}"
+def domain_rate(domain: str) -> float:
+    return DOMAIN_REQUESTS_PER_MIN.get(domain, REQUESTS_PER_MIN)
+class TokenBucket:
+    def __init__(self, per_min: float, burst: float):
+        self.rate = max(1, per_min) / 60.0
+        self.burst = max(1.0, burst)
+        self.tokens = 1.0
+        self.stamp = time.time()
+    def level(self, now: float) -> float:
+        return min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+    def ready_in(self, now: float) -> float:
+        return max(0.0, (1 - self.level(now)) / self.rate)
+    def take(self, now: float) -> float:
+        self.tokens = self.level(now) - 1
+        self.stamp = now
+        return max(0.0, -self.tokens / self.rate)
+class DomainScheduler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues: Dict[str, deque] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+    def bucket(self, domain: str) -> TokenBucket:
+        if domain not in self.buckets:
+            self.buckets[domain] = TokenBucket(domain_rate(domain), DOMAIN_BURST)
+        return self.buckets[domain]
+    def put(self, domain: str, task):
+        with self.lock:
+            self.queues.setdefault(domain, deque()).append(task)
+            self.bucket(domain)
+    def get(self) -> Optional[Tuple[float, Any]]:
+        with self.lock:
+            now = time.time()
+            ready = [(self.buckets[d].ready_in(now), d) for d, q in self.queues.items() if q]
+            if not ready:
+                return None
+            domain = min(ready)[1]
+            delay = self.buckets[domain].take(now)
+            return (delay + random.uniform(0.1, 0.3) if delay else 0.0), self.queues[domain].popleft()
+@timed("stable_get")
 def stable_get(driver, url: str, retries: int = 3, base_sleep: float = 0.6) -> bool:
     for attempt in range(1, retries + 1):
         try:
+            METRICS.inc("page_loads")
             driver.get(url)
-            time.sleep(base_sleep + random.uniform(0.1, 0.2))
+            pause(base_sleep + random.uniform(0.1, 0.2), "page_settle")
             return True
-        except (TimeoutException, WebDriverException) as e:
+        except (selenium_errors.TimeoutException, selenium_errors.WebDriverException) as e:
+            METRICS.inc("page_load_errors")
             log(f"    • Ошибка открытия [{attempt}/{retries}]: {e}")
-            time.sleep(base_sleep * (1.5 ** (attempt - 1)) + random.uniform(0.1, 0.3))
+            pause(base_sleep * (1.5 ** (attempt - 1)) + random.uniform(0.1, 0.3), "retry_backoff")
     return False
 def safe_find(ctx, by, value):
     try: return ctx.find_element(by, value)
-    except NoSuchElementException: return None
+    except selenium_errors.NoSuchElementException: return None
 def safe_finds(ctx, by, value):
     try: return ctx.find_elements(by, value)
-    except NoSuchElementException: return []
-def search_page_collect_cards(driver) -> List[str]:
+    except selenium_errors.NoSuchElementException: return []
+def search_page_collect_cards(driver, site: Optional[str] = None) -> List[str]:
     links = safe_finds(driver, By.XPATH, "//a[contains(@href,'/firm/') or contains(@href,'/branch/')]")
     out, seen = [], set()
     for a in links[:120]:
@@ -128,42 +447,219 @@ def search_page_collect_cards(driver) -> List[str]:
         if not href: continue
         m = re.search(r"(/(?:firm|branch)/\d+)", href)
         if not m: continue
-        card = f"{BASE_DOMAIN}/{CITY_SLUG}{m.group(1)}"
+        card = f"{site or default_site()}{m.group(1)}"
         if card not in seen:
             seen.add(card); out.append(card)
     return out
-def open_candidates_by_phone(driver, phones_raw: str, lon: Optional[float], lat: Optional[float]) -> List[str]:
-    urls: List[str] = []
-    for raw in split_phones(phones_raw):
-        for q in phone_variants(raw):
-            u = search_url(q, lon, lat)
-            log(f"    → Поиск по телефону: {q} → {u}")
-            if not stable_get(driver, u, retries=2): continue
-            found = search_page_collect_cards(driver)
-            log(f"      найдено карточек: {len(found)}")
-            urls.extend(found)
-    uniq, seen = [], set()
-    for u in urls:
-        if u not in seen: seen.add(u); uniq.append(u)
-    return uniq
-def open_candidates_by_id(fid_prefix: str) -> List[str]:
-    return [firm_url(fid_prefix), branch_url(fid_prefix)]
-def open_candidates_by_name(driver, name: str, lon: Optional[float], lat: Optional[float]) -> List[str]:
-    u = search_url(name, lon, lat)
-    log(f"    → Поиск по имени: {name} → {u}")
+CACHE_TABLES = ("search_cache", "row_cache", "hint_cache")
+class ResolveCache:
+    def __init__(self, path: str, ttl_days: float, empty_ttl_hours: float):
+        self.ttl = ttl_days * 86400
+        self.empty_ttl = empty_ttl_hours * 3600
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            for table in CACHE_TABLES:
+                self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, urls TEXT NOT NULL, ts REAL NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS resolve_stats (stage TEXT PRIMARY KEY, tries INTEGER NOT NULL, hits INTEGER NOT NULL)")
+        self.evict()
+    def evict(self):
+        with self.lock, self.conn:
+            for table in CACHE_TABLES:
+                self.conn.execute(f"DELETE FROM {table} WHERE ts < ?", (time.time() - self.ttl,))
+    def get(self, table: str, key: str) -> Optional[List[str]]:
+        with self.lock:
+            r = self.conn.execute(f"SELECT urls, ts FROM {table} WHERE key = ?", (key,)).fetchone()
+        if not r or r[1] < time.time() - self.ttl:
+            return None
+        value = json.loads(r[0])
+        if value == [] and r[1] < time.time() - self.empty_ttl:
+            return None
+        return value
+    def put(self, table: str, key: str, urls: List[str]):
+        with self.lock, self.conn:
+            self.conn.execute(f"INSERT OR REPLACE INTO {table} (key, urls, ts) VALUES (?, ?, ?)",
+                              (key, json.dumps(urls), time.time()))
+    def delete(self, table: str, key: str):
+        with self.lock, self.conn:
+            self.conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+    def record(self, stage: str, hit: bool):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO resolve_stats (stage, tries, hits) VALUES (?, 1, ?) "
+                              "ON CONFLICT(stage) DO UPDATE SET tries = tries + 1, hits = hits + excluded.hits",
+                              (stage, int(hit)))
+    def hit_rates(self) -> Dict[str, float]:
+        with self.lock:
+            rows = self.conn.execute("SELECT stage, tries, hits FROM resolve_stats").fetchall()
+        return {stage: (hits + 1) / (tries + 2) for stage, tries, hits in rows}
+_resolve_cache: Optional[ResolveCache] = None
+_resolve_cache_lock = threading.Lock()
+def get_resolve_cache() -> Optional[ResolveCache]:
+    global _resolve_cache
+    if not RESOLVE_CACHE_DB: return None
+    with _resolve_cache_lock:
+        if _resolve_cache is None:
+            _resolve_cache = ResolveCache(RESOLVE_CACHE_DB, RESOLVE_CACHE_TTL_DAYS, EMPTY_SEARCH_TTL_H)
+        return _resolve_cache
+def coords_key(lon: Optional[float], lat: Optional[float]) -> str:
+    return f"{lon:.4f},{lat:.4f}" if lon is not None and lat is not None else ""
+def search_cache_key(kind: str, q: str, lon: Optional[float], lat: Optional[float], site: Optional[str] = None) -> str:
+    return f"{site or default_site()}|{kind}|{(norm(q) or '').lower()}|{coords_key(lon, lat)}"
+def row_cache_key(fields: Dict[str, Any]) -> str:
+    parts = [fields.get("site") or default_site(), fields["id_pref"] or "", (norm(fields["name"]) or "").lower(),
+             only_digits(fields["phones"] or ""), coords_key(fields["lon"], fields["lat"])]
+    return hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+def cached_search(driver, kind: str, q: str, lon: Optional[float], lat: Optional[float],
+                  site: Optional[str] = None) -> Optional[List[str]]:
+    cache = get_resolve_cache()
+    key = search_cache_key(kind, q, lon, lat, site)
+    if cache:
+        hit = cache.get("search_cache", key)
+        if hit is not None:
+            log(f"      из кэша: {q} → {len(hit)} карточек")
+            return hit
+    u = search_url(q, lon, lat, site)
+    log(f"    → Поиск по {'телефону' if kind == 'phone' else 'имени'}: {q} → {u}")
     if not stable_get(driver, u, retries=2):
-        return []
-    found = search_page_collect_cards(driver)
+        return None
+    found = search_page_collect_cards(driver, site)
     log(f"      найдено карточек: {len(found)}")
+    if cache:
+        cache.put("search_cache", key, found)
     return found
-def filter_by_prefix(urls: List[str], want_prefix: Optional[str]) -> List[str]:
-    if not want_prefix: return urls
-    def url_id_prefix(u: str) -> Optional[str]:
-        m = re.search(r"/(?:firm|branch)/(\d+)", u)
-        return m.group(1) if m else None
-    filtered = [u for u in urls if url_id_prefix(u) == want_prefix]
-    return filtered or urls
-JS_FIND_REVIEWS_CONTAINER = r"""
+def card_id_from_url(u: str) -> Optional[str]:
+    m = re.search(r"/(?:firm|branch)/(\d+)", u or "")
+    return m.group(1) if m else None
+@timed("resolve_id")
+def open_card_by_id(driver, fid: str, site: Optional[str] = None) -> Optional[str]:
+    reset_capture(driver)
+    if not stable_get(driver, reviews_tab_url(firm_url(fid, site)), retries=2):
+        return None
+    title = (driver.title or "").lower()
+    if card_id_from_url(driver.current_url) != fid or "404" in title or "не найден" in title:
+        return None
+    return card_base_url(driver.current_url)
+def search_stages(fields: Dict[str, Any], cache: Optional[ResolveCache]) -> List[Tuple[str, str, str]]:
+    stages: List[Tuple[str, str, str]] = []
+    for raw in split_phones(fields["phones"]):
+        for k, q in enumerate(phone_variants(raw)):
+            stages.append((f"phone{k}", "phone", q))
+    if fields["name"]:
+        stages.append(("name", "name", fields["name"]))
+    if not cache:
+        return stages
+    rates = cache.hit_rates()
+    def rank(st):
+        stage, kind, q = st
+        cached = cache.get("search_cache", search_cache_key(kind, q, fields["lon"], fields["lat"], fields.get("site"))) is not None
+        return (not cached, -rates.get(stage, 0.5))
+    return sorted(stages, key=rank)
+def resolve_candidates(driver, fields: Dict[str, Any]) -> List[str]:
+    id_pref = fields["id_pref"]
+    cache = get_resolve_cache()
+    if id_pref:
+        url = open_card_by_id(driver, id_pref, fields.get("site"))
+        if cache: cache.record("id", url is not None)
+        if url:
+            METRICS.inc("resolved_by_id")
+            print(f"  Карточка по id: {url}")
+            return [url]
+        print(f"  Прямая ссылка по id {id_pref} не подтвердилась — поиск")
+    weak: List[str] = []
+    for stage, kind, q in search_stages(fields, cache):
+        with METRICS.timed(f"search_{kind}"):
+            found = cached_search(driver, kind, q, fields["lon"], fields["lat"], fields.get("site")) or []
+        if id_pref:
+            strong = [u for u in found if card_id_from_url(u) == id_pref]
+        else:
+            strong = found if kind == "phone" else []
+        if cache: cache.record(stage, bool(strong))
+        if strong:
+            METRICS.inc(f"resolved_by_{kind}")
+            print(f"  Кандидаты по {'телефону' if kind == 'phone' else 'имени'} ({stage}): {len(strong)}")
+            return strong
+        weak.extend(found)
+    weak = list(dict.fromkeys(weak))[:MAX_WEAK_CANDIDATES]
+    if weak:
+        METRICS.inc("resolved_weak")
+        print(f"  Уверенного совпадения нет, берём первые результаты поиска: {len(weak)}")
+    return weak
+JS_REVIEW_LIB = r"""
+function gisRoots(){
+  const roots = [document];
+  const tw = document.createTreeWalker(document, NodeFilter.SHOW_ELEMENT);
+  let n = tw.currentNode;
+  while(n) { if(n.shadowRoot) roots.push(n.shadowRoot); n = tw.nextNode(); }
+  return roots;
+}
+function ratingFromWidth(w){
+  if(!w) return null;
+  let m=(''+w).match(/([\d.]+)\s*px/i);
+  let px = m ? parseFloat(m[1]) : parseFloat(w);
+  if(!isFinite(px)) return null;
+  let val = px/10;
+  return (Math.round(val*10)/10).toString();
+}
+function extractReviewCount(text){
+  if(!text) return null;
+  let m = (''+text).match(/(\d+)/);
+  return m ? parseInt(m[1]) : null;
+}
+function readReview(el){
+  const text = (el.textContent || '').trim();
+  if (!text) return null;
+  let box = el, dateEl = null, rateEl = null, nameEl = null, reviewCountEl = null;
+  for (let step = 0; step < 12 && box; step++) {
+    if (!dateEl) dateEl = box.querySelector('div._a5f6uz,span._a5f6uz,time._a5f6uz,[class*="_a5f6uz"],[class*="date"],time');
+    if (!rateEl) rateEl = box.querySelector('div._1fkin5c,[class*="rating"],[class*="stars"]');
+    if (!nameEl) nameEl = box.querySelector('span._16s5yj36');
+    if (!reviewCountEl) reviewCountEl = box.querySelector('span._89b5km');
+    if (dateEl && rateEl && nameEl && reviewCountEl) break;
+    box = box.parentElement;
+  }
+  const date = dateEl ? (dateEl.textContent || '').trim() : null;
+  const name = nameEl ? (nameEl.getAttribute('title') || nameEl.textContent || '').trim() : null;
+  const reviewCount = reviewCountEl ? extractReviewCount(reviewCountEl.textContent) : null;
+  let w = null;
+  if (rateEl) {
+    try {
+      const cs = getComputedStyle(rateEl);
+      w = cs && cs.width ? cs.width : (rateEl.getAttribute('style') || '');
+    } catch(e) { w = rateEl.getAttribute('style') || ''; }
+  }
+  return {text, date, rating: ratingFromWidth(w), name, reviewCount};
+}
+function clickShowMore(roots, container){
+  const h = (container && container.getBoundingClientRect ? container.getBoundingClientRect().height : window.innerHeight) || 0;
+  const rx = /(показать|ещ[её]|more|show|load|дал[её]е|больше)/i;
+  let clicked = false;
+  for (const r of roots) {
+    for (const b of r.querySelectorAll('button, a, div[role="button"]')) {
+      try {
+        const t = (b.textContent || '').trim().toLowerCase();
+        const ar = (b.getAttribute('aria-label') || '').toLowerCase();
+        if (!(rx.test(t) || rx.test(ar))) continue;
+        if (b.getBoundingClientRect().top <= h*0.45) continue;
+        b.click();
+        clicked = true;
+      } catch(e) {}
+    }
+  }
+  return clicked;
+}
+function scrollToBottom(container){
+  if (!container) container = document.scrollingElement || document.body;
+  try {
+    const beforeHeight = container.scrollHeight;
+    container.scrollTop = container.scrollHeight;
+    container.dispatchEvent(new Event('scroll', {bubbles: true, cancelable: true}));
+    container.dispatchEvent(new WheelEvent('wheel', {deltaY: container.clientHeight, bubbles: true, cancelable: true}));
+    return container.scrollTop > 0 || container.scrollHeight > beforeHeight;
+  } catch(e) { return false; }
+}
+"""
+JS_FIND_REVIEWS_CONTAINER = JS_REVIEW_LIB + r"""
 return (function(){
   let container = null;
   try {
@@ -185,11 +681,7 @@ return (function(){
     }
   } catch(e) {}
   if (!container) {
-    const roots = [document];
-    const tw = document.createTreeWalker(document, NodeFilter.SHOW_ELEMENT);
-    let n = tw.currentNode;
-    while(n) { if(n.shadowRoot) roots.push(n.shadowRoot); n = tw.nextNode(); }
-    for (const r of roots) {
+    for (const r of gisRoots()) {
       const scrollables = r.querySelectorAll('[style*="overflow"],[class*="scroll"],[class*="review"]');
       for (const el of scrollables) {
         const st = getComputedStyle(el);
@@ -208,108 +700,96 @@ return (function(){
   return container;
 })();
 """
-JS_EXTRACT_VISIBLE = r"""
+JS_EXTRACT_VISIBLE = JS_REVIEW_LIB + r"""
 return (function(){
-  function ratingFromWidth(w){
-    if(!w) return null;
-    let m=(''+w).match(/([\d.]+)\s*px/i);
-    let px = m ? parseFloat(m[1]) : parseFloat(w);
-    if(!isFinite(px)) return null;
-    let val = px/10;
-    return (Math.round(val*10)/10).toString();
-  }
-  function extractReviewCount(text){
-    if(!text) return null;
-    let m = (''+text).match(/(\d+)/);
-    return m ? parseInt(m[1]) : null;
-  }
   const items = [];
-  const roots = [document];
-  const tw = document.createTreeWalker(document, NodeFilter.SHOW_ELEMENT);
-  let n = tw.currentNode;
-  while(n) { if(n.shadowRoot) roots.push(n.shadowRoot); n = tw.nextNode(); }
-  for (const r of roots) {
-    const texts = Array.from(r.querySelectorAll('a._1msln3t'));
-    for (const el of texts) {
-      let box = el, dateEl = null, rateEl = null, nameEl = null, reviewCountEl = null;
-      for (let step = 0; step < 12 && box; step++) {
-        if (!dateEl) dateEl = box.querySelector('div._a5f6uz,span._a5f6uz,time._a5f6uz,[class*="_a5f6uz"],[class*="date"],time');
-        if (!rateEl) rateEl = box.querySelector('div._1fkin5c,[class*="rating"],[class*="stars"]');
-        if (!nameEl) nameEl = box.querySelector('span._16s5yj36');
-        if (!reviewCountEl) reviewCountEl = box.querySelector('span._89b5km');
-        if (dateEl && rateEl && nameEl && reviewCountEl) break;
-        box = box.parentElement;
-      }
-      const text = (el.textContent || '').trim();
-      const date = dateEl ? (dateEl.textContent || '').trim() : null;
-      const name = nameEl ? (nameEl.getAttribute('title') || nameEl.textContent || '').trim() : null;
-      const reviewCount = reviewCountEl ? extractReviewCount(reviewCountEl.textContent) : null;
-      let w = null;
-      if (rateEl) {
-        try {
-          const cs = getComputedStyle(rateEl);
-          w = cs && cs.width ? cs.width : (rateEl.getAttribute('style') || '');
-        } catch(e) { w = rateEl.getAttribute('style') || ''; }
-      }
-      const rating = ratingFromWidth(w);
-      if (text) items.push({text, date, rating, name, reviewCount});
+  for (const r of gisRoots()) {
+    for (const el of r.querySelectorAll('a._1msln3t')) {
+      const item = readReview(el);
+      if (item) items.push(item);
     }
   }
   return items;
 })();
 """
-JS_SCROLL_TO_BOTTOM = r"""
-return (function(container){
-  if (!container) container = document.scrollingElement || document.body;
-  let moved = false;
-  try {
-    const beforeHeight = container.scrollHeight;
-    container.scrollTop = container.scrollHeight;
-    container.dispatchEvent(new Event('scroll', {bubbles: true, cancelable: true}));
-    container.dispatchEvent(new WheelEvent('wheel', {deltaY: container.clientHeight, bubbles: true, cancelable: true}));
-    moved = container.scrollTop > 0 || container.scrollHeight > beforeHeight;
-  } catch(e) {}
-  return moved;
-})(arguments[0]);
+JS_SCROLL_TO_BOTTOM = JS_REVIEW_LIB + r"""
+return scrollToBottom(arguments[0]);
 """
-JS_CLICK_SHOW_MORE = r"""
+JS_CLICK_SHOW_MORE = JS_REVIEW_LIB + r"""
 return (function(container){
-  function inBottomHalf(el){
-    try{
-      const r = el.getBoundingClientRect();
-      const h = (container && container.getBoundingClientRect ? container.getBoundingClientRect().height : window.innerHeight) || 0;
-      return r.top > h*0.45;
-    }catch(e){ return true; }
-  }
-  const rx = /(показать|ещ[её]|more|show|load|дал[её]е|больше)/i;
-  let clicked = false;
   for (let attempt = 0; attempt < 5; attempt++) {
-    const roots = [document];
-    const tw = document.createTreeWalker(document, NodeFilter.SHOW_ELEMENT);
-    let n = tw.currentNode;
-    while(n) { if(n.shadowRoot) roots.push(n.shadowRoot); n = tw.nextNode(); }
-    for (const r of roots) {
-      const nodes = r.querySelectorAll('button, a, div[role="button"]');
-      for (const b of nodes) {
-        try {
-          const t = (b.textContent || '').trim().toLowerCase();
-          const ar = (b.getAttribute('aria-label') || '').toLowerCase();
-          if (!(rx.test(t) || rx.test(ar))) continue;
-          if (!inBottomHalf(b)) continue;
-          b.click();
-          clicked = true;
-          (function(ms) {
-            var start = Date.now();
-            while(Date.now() - start < ms) {}
-          })(1200);
-        } catch(e) {}
-      }
-    }
-    if (clicked) break;
+    if (clickShowMore(gisRoots(), container)) return true;
   }
-  return clicked;
+  return false;
 })(arguments[0]);
 """
+JS_WAIT_FOR_GROWTH = r"""
+const done = arguments[arguments.length - 1];
+const prev = arguments[0], timeoutMs = arguments[1];
+const count = () => document.querySelectorAll('a._1msln3t').length;
+if (count() > prev) { done(count()); return; }
+let finished = false, timer = null;
+const obs = new MutationObserver(() => { if (count() > prev) finish(); });
+function finish() {
+  if (finished) return;
+  finished = true;
+  obs.disconnect();
+  clearTimeout(timer);
+  done(count());
+}
+obs.observe(document.body || document.documentElement, {childList: true, subtree: true});
+timer = setTimeout(finish, timeoutMs);
+"""
+JS_STEP = JS_REVIEW_LIB + r"""
+const done = arguments[arguments.length - 1];
+const container = arguments[0] || document.scrollingElement || document.body;
+const opts = arguments[1] || {};
+let st = window.__gisStep;
+if (opts.reset || !st) {
+  st = window.__gisStep = {roots: gisRoots(), gen: (st ? st.gen : 0) + 1};
+}
+const count = () => st.roots.reduce((s, r) => s + r.querySelectorAll('a._1msln3t').length, 0);
+function extractNew(){
+  const items = [];
+  for (const r of st.roots) {
+    for (const el of r.querySelectorAll('a._1msln3t')) {
+      if (el.__gisSent === st.gen) continue;
+      const item = readReview(el);
+      if (!item) continue;
+      el.__gisSent = st.gen;
+      items.push(item);
+    }
+  }
+  return items;
+}
+let clicked = false, moved = false;
+if (opts.act) {
+  clicked = clickShowMore(st.roots, container);
+  moved = scrollToBottom(container);
+}
+const prev = opts.prev || 0;
+let finished = false, timer = null, obs = null;
+function finish() {
+  if (finished) return;
+  finished = true;
+  if (obs) obs.disconnect();
+  clearTimeout(timer);
+  done({items: opts.extract ? extractNew() : [], count: count(), clicked: clicked, moved: moved});
+}
+if (!opts.wait || count() > prev) { finish(); }
+else {
+  obs = new MutationObserver(() => { if (count() > prev) finish(); });
+  obs.observe(document.body || document.documentElement, {childList: true, subtree: true});
+  timer = setTimeout(finish, opts.wait);
+}
+"""
+def wait_for_reviews(driver, prev: int, timeout: float = GROWTH_WAIT_TIMEOUT) -> int:
+    try:
+        with METRICS.timed("js:wait_for_growth"):
+            return int(driver.execute_async_script(JS_WAIT_FOR_GROWTH, prev, int(timeout * 1000)) or 0)
+    except Exception:
+        return prev
+@timed("total_hint")
 def extract_total_hint(driver) -> Optional[int]:
     for loc in [
         (By.XPATH, "//a[contains(@href,'reviews')]"),
@@ -324,118 +804,277 @@ def extract_total_hint(driver) -> Optional[int]:
                 try: return int(m.group(1).replace(" ",""))
                 except: pass
     return None
-def crawl_reviews_incremental(driver, total_hint: Optional[int]) -> List[Dict[str, Optional[str]]]:
+REVIEW_FIELDS = (
+    "review_id", "review_text", "review_date", "review_rating", "reviewer_name",
+    "reviewer_total_reviews", "review_link", "reviewer_profile_url", "likes_count",
+    "photos_count", "photos_urls", "owner_reply_text", "owner_reply_date",
+)
+class Review:
+    __slots__ = REVIEW_FIELDS
+    def __init__(self, **kw):
+        for f in REVIEW_FIELDS:
+            setattr(self, f, kw.get(f))
+    def as_dict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in REVIEW_FIELDS}
+class ReviewCapture:
+    def __init__(self, driver):
+        self.driver = driver
+        self.pending: Dict[str, str] = {}
+        self.api_url: Optional[str] = None
+        self.rx = re.compile(REVIEWS_API_RX)
+    def drain(self) -> List[Dict[str, Any]]:
+        try:
+            entries = self.driver.get_log("performance")
+        except Exception:
+            return []
+        items: List[Dict[str, Any]] = []
+        for e in entries:
+            try:
+                msg = json.loads(e["message"])["message"]
+            except (KeyError, ValueError, TypeError):
+                continue
+            method = msg.get("method")
+            params = msg.get("params") or {}
+            if method == "Network.responseReceived":
+                url = (params.get("response") or {}).get("url") or ""
+                if self.rx.search(url):
+                    self.pending[params.get("requestId")] = url
+                    self.api_url = url
+            elif method == "Network.loadingFinished" and params.get("requestId") in self.pending:
+                self.pending.pop(params["requestId"], None)
+                try:
+                    body = self.driver.execute_cdp_cmd("Network.getResponseBody", {"requestId": params["requestId"]})
+                    raw = body.get("body") or ""
+                    if body.get("base64Encoded"):
+                        raw = base64.b64decode(raw).decode("utf-8", "replace")
+                    data = json.loads(raw)
+                except Exception:
+                    continue
+                items.extend(data.get("reviews") or [])
+        return items
+def reset_capture(driver):
+    if not CAPTURE_NETWORK: return
+    try: driver.get_log("performance")
+    except Exception: pass
+def is_iso_date(s: Optional[str]) -> bool:
+    return bool(s and re.match(r"\d{4}-\d{2}-\d{2}", s))
+def review_text_key(rec: Review) -> Optional[str]:
+    txt = norm(rec.review_text)
+    if not txt: return None
+    return hashlib.md5((txt + "|" + (norm(rec.reviewer_name) or "")).encode("utf-8")).hexdigest()
+class KnownReviews:
+    def __init__(self, ids: set, latest: Optional[str], text_keys: Optional[set] = None):
+        self.ids = ids
+        self.latest = latest
+        self.text_keys = text_keys or set()
+    def __contains__(self, rec: Review) -> bool:
+        if rec.review_id in self.ids: return True
+        if review_text_key(rec) in self.text_keys: return True
+        return bool(self.latest and is_iso_date(rec.review_date) and rec.review_date < self.latest)
+class ReviewIndex:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS review_index (card_id TEXT NOT NULL, review_id TEXT NOT NULL, "
+                              "review_date TEXT, ts REAL NOT NULL, PRIMARY KEY (card_id, review_id))")
+            if "text_key" not in {r[1] for r in self.conn.execute("PRAGMA table_info(review_index)")}:
+                self.conn.execute("ALTER TABLE review_index ADD COLUMN text_key TEXT")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS card_index (card_id TEXT PRIMARY KEY, url TEXT NOT NULL, "
+                              "total_hint INTEGER, reviews BLOB NOT NULL, ts REAL NOT NULL)")
+    def known(self, card_id: str) -> KnownReviews:
+        with self.lock:
+            rows = self.conn.execute("SELECT review_id, review_date, text_key FROM review_index WHERE card_id = ?",
+                                     (card_id,)).fetchall()
+        iso = [d for _, d, _ in rows if is_iso_date(d)]
+        return KnownReviews({r for r, _, _ in rows}, max(iso) if iso else None, {t for _, _, t in rows if t})
+    def add(self, card_id: str, reviews: List[Review]):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO review_index (card_id, review_id, review_date, ts, text_key) "
+                                  "VALUES (?, ?, ?, ?, ?)",
+                                  [(card_id, r.review_id, r.review_date, now, review_text_key(r)) for r in reviews])
+    def card(self, card_id: str, max_age: float) -> Optional[Tuple[str, Optional[int], List[Dict[str, Any]], float]]:
+        with self.lock:
+            r = self.conn.execute("SELECT url, total_hint, reviews, ts FROM card_index WHERE card_id = ?", (card_id,)).fetchone()
+        if not r or r[3] < time.time() - max_age:
+            return None
+        return r[0], r[1], json.loads(zlib.decompress(r[2]).decode("utf-8")), r[3]
+    def put_card(self, card_ids: List[str], url: str, total_hint: Optional[int], reviews: List[Review]):
+        blob = zlib.compress(json.dumps([r.as_dict() for r in reviews], ensure_ascii=False, default=str).encode("utf-8"))
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO card_index (card_id, url, total_hint, reviews, ts) VALUES (?, ?, ?, ?, ?)",
+                                  [(cid, url, total_hint, blob, now) for cid in dict.fromkeys(card_ids)])
+_review_index: Optional[ReviewIndex] = None
+def get_review_index() -> Optional[ReviewIndex]:
+    global _review_index
+    if not REVIEW_INDEX_DB: return None
+    with _resolve_cache_lock:
+        if _review_index is None:
+            _review_index = ReviewIndex(REVIEW_INDEX_DB)
+        return _review_index
+def indexed_card(url: str) -> Optional[Tuple[str, Optional[int], List[Dict[str, Any]], float]]:
+    if INCREMENTAL or not CARD_INDEX_MAX_AGE_H: return None
+    index = get_review_index()
+    card_id = card_id_from_url(url)
+    if not (index and card_id): return None
+    return index.card(card_id, CARD_INDEX_MAX_AGE_H * 3600)
+@timed("crawl_dom")
+def crawl_reviews_incremental(driver, total_hint: Optional[int], known: Optional[KnownReviews] = None,
+                              max_steps: Optional[int] = None, hard_timeout: Optional[float] = None) -> Tuple[List[Review], str]:
     start = time.time()
     seen_keys: set[str] = set()
-    collected: List[Dict[str, Optional[str]]] = []
+    seen_texts: set[str] = set()
+    collected: List[Review] = []
+    known_seen: set[str] = set()
+    page_known = 0
+    capture = ReviewCapture(driver) if CAPTURE_NETWORK else None
+    def add_captured(items) -> int:
+        nonlocal page_known
+        added = 0
+        for it in items:
+            rec = review_from_api(it)
+            if not rec or rec.review_id in seen_keys: continue
+            if known and rec in known:
+                known_seen.add(rec.review_id); page_known += 1
+                continue
+            seen_keys.add(rec.review_id)
+            seen_texts.add(rec.review_text)
+            collected.append(rec)
+            added += 1
+        return added
+    def add_visible(batch) -> int:
+        nonlocal page_known
+        added = 0
+        for it in batch:
+            txt = norm(it.get("text"))
+            dt  = norm(it.get("date"))
+            if not txt or (capture_mode and txt in seen_texts): continue
+            key = hashlib.md5((txt + "|" + (dt or "")).encode("utf-8")).hexdigest()
+            if key in seen_keys: continue
+            rec = Review(
+                review_id=key,
+                review_text=txt,
+                review_date=dt,
+                review_rating=norm(it.get("rating")),
+                reviewer_name=norm(it.get("name")),
+                reviewer_total_reviews=it.get("reviewCount"),
+            )
+            if known and rec in known:
+                known_seen.add(key); page_known += 1
+                continue
+            seen_keys.add(key)
+            seen_texts.add(txt)
+            collected.append(rec)
+            added += 1
+        return added
     try:
-        container = driver.execute_script(JS_FIND_REVIEWS_CONTAINER)
+        container = run_js(driver, "find_container", JS_FIND_REVIEWS_CONTAINER)
     except Exception:
         container = None
     try:
         body = driver.find_element(By.TAG_NAME, "body")
-        body.send_keys(Keys.HOME); time.sleep(0.15)
+        body.send_keys(Keys.HOME); pause(0.15, "keys")
         ActionChains(driver).move_by_offset(random.randint(100, 300), random.randint(100, 300)).perform()
     except Exception:
         pass
+    dom_count = 0
     try:
-        review_elements = driver.execute_script("return document.querySelectorAll('a._1msln3t').length;")
-        if not review_elements:
+        dom_count = int(run_js(driver, "count_reviews", "return document.querySelectorAll('a._1msln3t').length;") or 0)
+        if not dom_count:
             log("      • Отзывы отсутствуют, пропускаем скроллинг")
-            return []
+            return [], "zero"
     except Exception:
         log("      • Не удалось проверить наличие отзывов, продолжаем")
-    try:
-        batch = driver.execute_script(JS_EXTRACT_VISIBLE) or []
-        for it in batch:
-            txt = norm(it.get("text"))
-            dt  = norm(it.get("date"))
-            if not txt: continue
-            key = hashlib.md5((txt + "|" + (dt or "")).encode("utf-8")).hexdigest()
-            if key in seen_keys: continue
-            seen_keys.add(key)
-            collected.append({
-                "review_id": key,
-                "review_text": txt,
-                "review_date": dt,
-                "review_rating": norm(it.get("rating")),
-                "reviewer_name": norm(it.get("name")),
-                "reviewer_total_reviews": it.get("reviewCount"),
-                "review_link": None,
-                "reviewer_profile_url": None,
-                "likes_count": None,
-                "photos_count": None,
-                "photos_urls": None,
-                "owner_reply_text": None,
-                "owner_reply_date": None,
-            })
-        log(f"      • Начальная загрузка: собрано {len(collected)}")
-    except Exception:
-        pass
-    stable_iters = 0
-    last_count = len(collected)
-    for step in range(1, MAX_LOAD_STEPS + 1):
-        if time.time() - start > PER_CARD_HARD_TIMEOUT:
-            log("      • Таймаут по карточке — стоп")
-            break
+    batched = True
+    def step_js(act: bool, extract: bool, wait: float, reset: bool = False) -> Optional[Dict[str, Any]]:
+        nonlocal batched, dom_count
+        if not batched: return None
+        opts = {"act": act, "extract": extract, "wait": int(wait * 1000), "reset": reset, "prev": dom_count}
         try:
-            batch = driver.execute_script(JS_EXTRACT_VISIBLE) or []
+            with METRICS.timed("js:step"):
+                res = driver.execute_async_script(JS_STEP, container, opts)
         except Exception:
-            batch = []
-        added = 0
-        for it in batch:
-            txt = norm(it.get("text"))
-            dt  = norm(it.get("date"))
-            if not txt: continue
-            key = hashlib.md5((txt + "|" + (dt or "")).encode("utf-8")).hexdigest()
-            if key in seen_keys: continue
-            seen_keys.add(key)
-            collected.append({
-                "review_id": key,
-                "review_text": txt,
-                "review_date": dt,
-                "review_rating": norm(it.get("rating")),
-                "reviewer_name": norm(it.get("name")),
-                "reviewer_total_reviews": it.get("reviewCount"),
-                "review_link": None,
-                "reviewer_profile_url": None,
-                "likes_count": None,
-                "photos_count": None,
-                "photos_urls": None,
-                "owner_reply_text": None,
-                "owner_reply_date": None,
-            })
-            added += 1
-        log(f"      • Шаг {step}: в DOM видно {len(batch)}, всего собрано {len(collected)} (+{added})")
-        if total_hint and len(collected) >= total_hint:
-            log("      • Достигнуто ожидаемое количество отзывов")
-            break
-        clicked = False
+            res = None
+        if not isinstance(res, dict):
+            log("      • Пакетный шаг недоступен — отдельные вызовы")
+            batched = False
+            return None
+        dom_count = int(res.get("count") or 0)
+        return res
+    def extract_js() -> List[Dict[str, Any]]:
         try:
-            clicked = bool(driver.execute_script(JS_CLICK_SHOW_MORE, container))
-            if clicked:
-                log("      • Кликнули «Ещё»")
-                time.sleep(1.2 + random.uniform(0.1, 0.2))
+            return run_js(driver, "extract_visible", JS_EXTRACT_VISIBLE) or []
+        except Exception:
+            return []
+    def act_js(wait: float) -> Tuple[bool, bool]:
+        nonlocal dom_count
+        clicked = moved = False
+        try:
+            clicked = bool(run_js(driver, "click_show_more", JS_CLICK_SHOW_MORE, container))
         except Exception:
             pass
         try:
-            moved = bool(driver.execute_script(JS_SCROLL_TO_BOTTOM, container))
+            moved = bool(run_js(driver, "scroll_to_bottom", JS_SCROLL_TO_BOTTOM, container))
             ActionChains(driver).move_by_offset(random.randint(-30, 30), random.randint(-30, 30)).perform()
             if random.random() < 0.2:
-                driver.execute_script("window.scrollBy(0, -100);")
-                time.sleep(0.1)
-                driver.execute_script("window.scrollBy(0, 100);")
+                run_js(driver, "scroll_by", "window.scrollBy(0, -100);")
+                pause(0.1, "scroll_jitter")
+                run_js(driver, "scroll_by", "window.scrollBy(0, 100);")
         except Exception:
-            moved = False
+            pass
+        dom_count = wait_for_reviews(driver, dom_count, wait)
+        return clicked, moved
+    capture_mode = bool(capture and add_captured(capture.drain()))
+    batch: Optional[List[Dict[str, Any]]] = None
+    if capture_mode:
+        log(f"      • Начальная загрузка (сеть): собрано {len(collected)}")
+        step_js(act=False, extract=False, wait=0, reset=True)
+    else:
+        res = step_js(act=False, extract=True, wait=0, reset=True)
+        batch = res["items"] if res else None
+    stable_iters = 0
+    last_count = len(collected)
+    reason = "max_steps"
+    for step in range(1, (max_steps or MAX_LOAD_STEPS) + 1):
+        if time.time() - start > (hard_timeout or PER_CARD_HARD_TIMEOUT):
+            log("      • Таймаут по карточке — стоп")
+            reason = "hard_timeout"
+            break
+        page_known = 0
+        if capture_mode:
+            added = add_captured(capture.drain())
+            log(f"      • Шаг {step}: из сети всего собрано {len(collected)} (+{added})")
+        else:
+            if batch is None:
+                batch = extract_js()
+            added = add_visible(batch)
+            log(f"      • Шаг {step}: в DOM {dom_count}, новых {len(batch)}, всего собрано {len(collected)} (+{added})")
+        if total_hint and len(collected) + len(known_seen) >= total_hint:
+            log("      • Достигнуто ожидаемое количество отзывов")
+            reason = "hint_reached"
+            break
+        if known and page_known and not added:
+            log("      • На странице только известные отзывы — стоп")
+            return collected, "known"
+        res = step_js(act=True, extract=not capture_mode, wait=GROWTH_WAIT_TIMEOUT)
+        if res is not None:
+            clicked, moved = bool(res.get("clicked")), bool(res.get("moved"))
+            batch = res.get("items") or []
+        else:
+            clicked, moved = act_js(GROWTH_WAIT_TIMEOUT)
+            batch = None
+        if clicked:
+            log("      • Кликнули «Ещё»")
         if not moved and not clicked:
             try:
                 body = driver.find_element(By.TAG_NAME, "body")
-                body.send_keys(Keys.PAGE_DOWN); time.sleep(0.1)
-                body.send_keys(Keys.END); time.sleep(0.15)
+                body.send_keys(Keys.PAGE_DOWN); pause(0.1, "keys")
+                body.send_keys(Keys.END); pause(0.15, "keys")
             except Exception:
                 pass
-        wait_time = 1.5 + random.uniform(0.1, 0.2) if clicked else WAIT_SMALL + random.uniform(0.1, 0.2) + (0.2 if len(collected) > 50 else 0.0)
-        time.sleep(wait_time)
         if len(collected) == last_count:
             stable_iters += 1
         else:
@@ -443,205 +1082,1741 @@ def crawl_reviews_incremental(driver, total_hint: Optional[int]) -> List[Dict[st
             last_count = len(collected)
         if stable_iters >= STAGNATION_ROUNDS:
             log(f"      • Стагнация ({stable_iters}/{STAGNATION_ROUNDS})")
+            reason = "stagnation"
             break
     try:
-        for _ in range(3):
-            clicked = bool(driver.execute_script(JS_CLICK_SHOW_MORE, container))
-            if clicked:
-                log("      • Финальный клик «Ещё»")
-                time.sleep(1.2 + random.uniform(0.1, 0.2))
-        for _ in range(3):
-            driver.execute_script(JS_SCROLL_TO_BOTTOM, container)
-            time.sleep(1.5 + random.uniform(0.1, 0.2))
-        batch2 = driver.execute_script(JS_EXTRACT_VISIBLE) or []
-        for it in batch2:
-            txt = norm(it.get("text"))
-            dt  = norm(it.get("date"))
-            if not txt: continue
-            key = hashlib.md5((txt + "|" + (dt or "")).encode("utf-8")).hexdigest()
-            if key in seen_keys: continue
-            seen_keys.add(key)
-            collected.append({
-                "review_id": key,
-                "review_text": txt,
-                "review_date": dt,
-                "review_rating": norm(it.get("rating")),
-                "reviewer_name": norm(it.get("name")),
-                "reviewer_total_reviews": it.get("reviewCount"),
-                "review_link": None,
-                "reviewer_profile_url": None,
-                "likes_count": None,
-                "photos_count": None,
-                "photos_urls": None,
-                "owner_reply_text": None,
-                "owner_reply_date": None,
-            })
+        if batch:
+            add_visible(batch)
+        for _ in range(0 if reason == "hint_reached" else 3):
+            prev = dom_count
+            res = step_js(act=True, extract=not capture_mode, wait=WAIT_SMALL + 1.0)
+            if res is not None:
+                add_visible(res.get("items") or [])
+            else:
+                act_js(WAIT_SMALL + 1.0)
+            if dom_count <= prev:
+                break
+        if capture_mode:
+            add_captured(capture.drain())
+        res = step_js(act=False, extract=True, wait=0)
+        add_visible((res.get("items") or []) if res is not None else extract_js())
         log(f"      • Финальный добор: всего {len(collected)}")
     except Exception:
         pass
-    return collected
+    return collected, reason
+JS_FIND_REVIEWS_API = r"""
+return (function(rx){
+  const re = new RegExp(rx);
+  const urls = performance.getEntriesByType('resource').map(e => e.name).filter(n => re.test(n));
+  return urls.length ? urls[urls.length - 1] : null;
+})(arguments[0]);
+"""
+_http_local = threading.local()
+def http_session() -> requests.Session:
+    sess = getattr(_http_local, "session", None)
+    if sess is None:
+        sess = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.6, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET"]))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        sess.mount("https://", adapter)
+        sess.mount("http://", adapter)
+        _http_local.session = sess
+    return sess
+def find_reviews_api_url(driver, wait: float = 3.0) -> Optional[str]:
+    deadline = time.time() + wait
+    while True:
+        try:
+            u = run_js(driver, "find_reviews_api", JS_FIND_REVIEWS_API, REVIEWS_API_RX)
+        except Exception:
+            u = None
+        if u or time.time() >= deadline:
+            return u
+        pause(0.3, "api_discovery")
+def api_page_url(url: str, limit: int, sort_by: Optional[str] = None) -> str:
+    parts = urllib.parse.urlsplit(url)
+    drop = ("limit", "offset", "offset_date") + (("sort_by",) if sort_by else ())
+    q = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True) if k not in drop]
+    q.append(("limit", str(limit)))
+    if sort_by: q.append(("sort_by", sort_by))
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(q)))
+def review_from_api(it: Dict[str, Any]) -> Optional[Review]:
+    txt = norm(it.get("text"))
+    if not txt: return None
+    dt = norm(it.get("date_edited") or it.get("date_created"))
+    rid = it.get("id")
+    user = it.get("user") or {}
+    answer = it.get("official_answer") or {}
+    photos = it.get("photos") or []
+    photo_urls = []
+    for ph in photos:
+        prev = ph.get("preview_urls") or {}
+        u = ph.get("url") or prev.get("url") or next(iter(prev.values()), None)
+        if u: photo_urls.append(u)
+    rating = it.get("rating")
+    return Review(
+        review_id=str(rid) if rid else hashlib.md5((txt + "|" + (dt or "")).encode("utf-8")).hexdigest(),
+        review_text=txt,
+        review_date=dt,
+        review_rating=str(rating) if rating is not None else None,
+        reviewer_name=norm(user.get("name")),
+        reviewer_total_reviews=user.get("reviews_count"),
+        review_link=it.get("url"),
+        reviewer_profile_url=user.get("url"),
+        likes_count=it.get("likes_count"),
+        photos_count=len(photos),
+        photos_urls=" ".join(photo_urls) or None,
+        owner_reply_text=norm(answer.get("text")),
+        owner_reply_date=norm(answer.get("date_created")),
+    )
+def expected_reviews(fields: Dict[str, Any]) -> Optional[int]:
+    cache = get_resolve_cache()
+    if cache:
+        cards = cache.get("row_cache", row_cache_key(fields))
+        if cards:
+            ids = [c for c in (card_id_from_url(u) for u in cards) if c]
+        else:
+            ids = [fields["id_pref"]] if fields["id_pref"] else []
+        hints = [h for h in (cache.get("hint_cache", card_id) for card_id in ids) if h is not None]
+        if hints:
+            return sum(hints)
+    return fields.get("reviews")
+_deadline: Optional[float] = None
+_plan_lock = threading.Lock()
+_plan_left = 0.0
+_plan_workers = 1
+_row_cost: Dict[Any, float] = {}
+def budget_left() -> Optional[float]:
+    return None if _deadline is None else _deadline - time.time()
+def budget_share() -> float:
+    left = budget_left()
+    with _plan_lock:
+        if left is None or _plan_left <= 0:
+            return 1.0
+        return min(1.0, max(0.0, left) * _plan_workers / _plan_left)
+def base_budget(total_hint: Optional[int]) -> Tuple[int, float, bool]:
+    use_api = False
+    if not total_hint:
+        steps, timeout = MAX_LOAD_STEPS, PER_CARD_HARD_TIMEOUT
+    elif total_hint <= SMALL_CARD_REVIEWS:
+        steps, timeout = 1, min(PER_CARD_HARD_TIMEOUT, 30)
+    elif total_hint >= HUGE_CARD_REVIEWS:
+        steps = max(MAX_LOAD_STEPS, total_hint // REVIEWS_PER_STEP + STAGNATION_ROUNDS)
+        timeout = max(PER_CARD_HARD_TIMEOUT, HUGE_CARD_TIMEOUT)
+        use_api = True
+    else:
+        steps = min(MAX_LOAD_STEPS, total_hint // REVIEWS_PER_STEP + STAGNATION_ROUNDS + 2)
+        timeout = min(PER_CARD_HARD_TIMEOUT, 30 + total_hint * SECONDS_PER_REVIEW)
+    return steps, timeout, use_api
+def card_budget(total_hint: Optional[int]) -> Tuple[int, float, bool]:
+    steps, timeout, use_api = base_budget(total_hint)
+    left = budget_left()
+    if left is not None:
+        timeout = max(min(timeout, 30.0), timeout * budget_share())
+        timeout = max(5.0, min(timeout, left))
+    return steps, timeout, use_api
+def plan_done(key):
+    global _plan_left
+    with _plan_lock:
+        _plan_left = max(0.0, _plan_left - _row_cost.pop(key, 0.0))
+@timed("prepass")
+def plan_rows(tasks: List[Tuple[Any, int, Any, tuple]], n_workers: int) -> List[Tuple[Any, int, Any, tuple]]:
+    global _plan_left, _plan_workers
+    sizes = [expected_reviews(read_row(values, run.site)) for run, pos, i, values in tasks]
+    known = [n for n in sizes if n is not None]
+    fill = sum(known) / len(known) if known else None
+    with _plan_lock:
+        _row_cost.clear()
+        for (run, pos, i, values), size in zip(tasks, sizes):
+            _row_cost[(run.k, pos)] = base_budget(fill if size is None else size)[1]
+        _plan_left = sum(_row_cost.values())
+        _plan_workers = max(1, n_workers)
+    print(f"Предварительный проход: размер известен для {len(known)} из {len(tasks)} строк, "
+          f"ожидается отзывов ≈{sum(known)}, лимит времени по карточкам ≈{_plan_left / 60 / _plan_workers:.0f} мин")
+    share = budget_share()
+    if share < 1:
+        print(f"Бюджет времени меньше: таймауты карточек ×{share:.2f} (не меньше 30 с)")
+    if not SIZE_ORDER:
+        return tasks
+    window = SIZE_ORDER_WINDOW or len(tasks)
+    order: List[int] = []
+    for start in range(0, len(tasks), window):
+        order += sorted(range(start, min(start + window, len(tasks))),
+                        key=lambda k: -((fill or 0) if sizes[k] is None else sizes[k]))
+    print(f"Крупные карточки идут первыми в окнах по {window} строк")
+    return [tasks[k] for k in order]
+@timed("fetch_api")
+def fetch_reviews_api(driver, total_hint: Optional[int], known: Optional[KnownReviews] = None) -> Optional[Tuple[List[Review], str]]:
+    api_url = find_reviews_api_url(driver)
+    if not api_url:
+        log("      • API отзывов не найден на странице")
+        return None
+    sess = http_session()
+    try:
+        ua = run_js(driver, "user_agent", "return navigator.userAgent;")
+    except Exception:
+        ua = None
+    headers = {"Referer": driver.current_url, "Origin": site_origin(driver.current_url), "Accept": "application/json"}
+    if ua: headers["User-Agent"] = ua
+    url: Optional[str] = api_page_url(api_url, API_PAGE_LIMIT, "date_edited" if known else None)
+    seen_keys: set[str] = set()
+    collected: List[Review] = []
+    n_known = 0
+    pages = 0
+    reason = "max_steps"
+    while url and pages < API_MAX_PAGES:
+        try:
+            resp = sess.get(url, headers=headers, timeout=API_TIMEOUT)
+            resp.raise_for_status()
+            data = resp.json()
+        except (requests.RequestException, ValueError) as e:
+            log(f"      • Ошибка API отзывов (стр. {pages + 1}): {e}")
+            return (collected, "api_error") if collected else None
+        pages += 1
+        items = data.get("reviews") or []
+        added = page_known = 0
+        for it in items:
+            rec = review_from_api(it)
+            if not rec or rec.review_id in seen_keys: continue
+            seen_keys.add(rec.review_id)
+            if known and rec in known:
+                page_known += 1
+                continue
+            collected.append(rec)
+            added += 1
+        n_known += page_known
+        meta = data.get("meta") or {}
+        total = meta.get("total_count") or total_hint
+        log(f"      • API стр. {pages}: +{added}, всего {len(collected)} (из {total or '—'})")
+        if known and page_known and not added:
+            log("      • На странице только известные отзывы — стоп")
+            reason = "known"
+            break
+        if total and len(collected) + n_known >= total:
+            reason = "hint_reached"
+            break
+        if not items or not (added or page_known):
+            reason = "zero" if not collected and not n_known else "stagnation"
+            break
+        url = meta.get("next_link")
+        if not url:
+            reason = "end"
+        if url:
+            pause(random.uniform(0.2, 0.4), "api_page")
+    return collected, reason
 ID_COLS   = ["id", "firm_id", "2gis_id"]
 NAME_COLS = ["name", "Название", "title"]
 PHONE_COLS= ["phones", "phone", "телефон", "номер", "phone_number", "contacts"]
 LAT_COLS  = ["lat", "latitude"]
 LON_COLS  = ["lon", "longitude", "lng"]
-def save_progress(rows: List[Dict[str, Any]], chunk_idx: int):
-    if not os.path.isdir(OUT_DIR):
-        os.makedirs(OUT_DIR, exist_ok=True)
-    pd.DataFrame(rows).to_csv(OUT_PROGRESS, index=False, encoding="utf-8-sig")
-    if rows:
-        chunk_path = os.path.join(OUT_DIR, f"2gis_reviews_chunk_{chunk_idx:03}.csv")
-        pd.DataFrame(rows).to_csv(chunk_path, index=False, encoding="utf-8-sig")
-        log(f"💾 Сохранено: {OUT_PROGRESS} и {chunk_path}")
-def main():
-    print("Файл загружен, вызываю main() ...", flush=True)
-    if not os.path.exists(EXCEL_PATH):
-        print(f"ОШИБКА: файл не найден: {EXCEL_PATH}", flush=True)
+REVIEWS_COLS = ["rating_cnt", "reviews_count", "review_count", "reviews", "отзывов"]
+OUT_COLUMNS = [
+    "src_row_index", "firm_id", "org_name", "two_gis_url", "rating_value", "rating_reviews",
+    "review_id", "review_date", "review_rating", "reviewer_name", "reviewer_total_reviews",
+    "reviewer_profile_url", "review_text", "likes_count", "photos_count", "photos_urls",
+    "owner_reply_text", "owner_reply_date", "review_link", "error", "stop_reason", "scraped_at",
+]
+PARQUET_INT_COLUMNS  = ("src_row_index", "rating_reviews", "reviewer_total_reviews", "likes_count", "photos_count")
+PARQUET_DICT_COLUMNS = ("firm_id", "org_name", "two_gis_url", "stop_reason")
+def parquet_schema(pa):
+    fields = []
+    for c in OUT_COLUMNS:
+        if c in PARQUET_INT_COLUMNS: t = pa.int64()
+        elif c == "rating_value": t = pa.float64()
+        elif c in PARQUET_DICT_COLUMNS: t = pa.dictionary(pa.int32(), pa.string())
+        else: t = pa.string()
+        fields.append(pa.field(c, t))
+    return pa.schema(fields)
+def parquet_table(pa, schema, rows: List[Dict[str, Any]]):
+    def num(v, cast):
+        if v is None or v == "": return None
+        try: return cast(v)
+        except (TypeError, ValueError): return None
+    arrays = []
+    for field in schema:
+        vals = [r.get(field.name) for r in rows]
+        if pa.types.is_int64(field.type):
+            arrays.append(pa.array([num(v, int) for v in vals], field.type))
+        elif pa.types.is_float64(field.type):
+            arrays.append(pa.array([num(v, float) for v in vals], field.type))
+        else:
+            arr = pa.array([None if v is None else str(v) for v in vals], pa.string())
+            arrays.append(arr.dictionary_encode() if pa.types.is_dictionary(field.type) else arr)
+    return pa.Table.from_arrays(arrays, schema=schema)
+def open_csv(path: str):
+    f = open(path, "w", newline="", encoding="utf-8-sig")
+    w = csv.DictWriter(f, fieldnames=OUT_COLUMNS, extrasaction="ignore")
+    w.writeheader()
+    return f, w
+class ProgressSink:
+    def __init__(self, path: str, out_dir: str, parquet_path: Optional[str]):
+        os.makedirs(out_dir, exist_ok=True)
+        self.path = path
+        self.out_dir = out_dir
+        self.f, self.w = open_csv(path)
+        self.chunk_f = self.chunk_w = None
+        self.chunk_rows = 0
+        self.count = 0
+        self.pq_writer = None
+        self.pq_rows: List[Dict[str, Any]] = []
+        if parquet_path:
+            try:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+            except ImportError:
+                log(f"!! pyarrow не установлен — {parquet_path} не пишется")
+            else:
+                self.pa = pa
+                self.pq_schema = parquet_schema(pa)
+                self.pq_writer = pq.ParquetWriter(parquet_path, self.pq_schema, compression="zstd")
+    def write(self, rows: List[Dict[str, Any]]):
+        if not rows: return
+        if self.pq_writer is not None:
+            self.pq_rows.extend(rows)
+        if self.chunk_f is None:
+            self.chunk_path = os.path.join(self.out_dir, "2gis_reviews_chunk.partial.csv")
+            self.chunk_f, self.chunk_w = open_csv(self.chunk_path)
+        self.w.writerows(rows)
+        self.chunk_w.writerows(rows)
+        self.f.flush()
+        self.chunk_f.flush()
+        self.chunk_rows += len(rows)
+        self.count += len(rows)
+    def end_chunk(self, chunk_idx: int):
+        if self.pq_rows:
+            table = parquet_table(self.pa, self.pq_schema, self.pq_rows)
+            self.pq_writer.write_table(table, row_group_size=table.num_rows)
+            self.pq_rows = []
+        if self.chunk_f is None: return
+        self.chunk_f.close()
+        chunk_path = os.path.join(self.out_dir, f"2gis_reviews_chunk_{chunk_idx:03}.csv")
+        os.replace(self.chunk_path, chunk_path)
+        log(f"💾 Сохранено: {self.path} (+{self.chunk_rows}, всего {self.count}) и {chunk_path}")
+        self.chunk_f = self.chunk_w = None
+        self.chunk_rows = 0
+    def close(self, chunk_idx: int):
+        self.end_chunk(chunk_idx)
+        self.f.close()
+        if self.pq_writer is not None:
+            self.pq_writer.close()
+RU_MONTHS = {"янв": 1, "фев": 2, "мар": 3, "апр": 4, "мая": 5, "май": 5, "июн": 6,
+             "июл": 7, "авг": 8, "сен": 9, "окт": 10, "ноя": 11, "дек": 12}
+CLEAN_TEXT_COLUMNS = ("org_name", "reviewer_name", "review_text", "owner_reply_text", "review_date", "owner_reply_date")
+def clean_text(s: pd.Series) -> pd.Series:
+    s = s.astype("string").str.replace(r"\s+", " ", regex=True).str.strip()
+    return s.mask(s == "")
+def assemble_dates(year, month, day, index) -> pd.Series:
+    parts = pd.DataFrame({"year": year, "month": month, "day": day}, index=index).astype("float64")
+    ok = parts.notna().all(axis=1)
+    out = pd.Series(pd.NaT, index=index, dtype="datetime64[ns]")
+    out[ok] = pd.to_datetime(parts[ok].astype("int64"), errors="coerce")
+    return out
+def parse_review_dates(s: pd.Series, now) -> pd.Series:
+    if not isinstance(now, pd.Series):
+        now = pd.Series(pd.Timestamp(now), index=s.index)
+    raw = clean_text(s)
+    iso = raw.where(raw.str.match(r"\d{4}-\d{2}-\d{2}", na=False))
+    t = raw.str.lower().str.replace(r",?\s*(?:отредактирован|изменен|изменён).*$", "", regex=True)
+    out = pd.to_datetime(iso.str.slice(0, 19), errors="coerce", format="ISO8601")
+    m = t.str.extract(r"^(\d{1,2}) ([а-я]+)(?: (\d{4}))?")
+    month = m[1].str[:3].map(RU_MONTHS)
+    year = pd.to_numeric(m[2], errors="coerce")
+    absolute = assemble_dates(year.fillna(now.dt.year), month, pd.to_numeric(m[0], errors="coerce"), t.index)
+    absolute = absolute.mask(year.isna() & (absolute > now), absolute - pd.DateOffset(years=1))
+    out = out.fillna(absolute)
+    day = now.dt.normalize()
+    back = t.map({"сегодня": 0, "вчера": 1, "позавчера": 2})
+    out = out.fillna(day - pd.to_timedelta(back, unit="D"))
+    r = t.str.extract(r"^(\d+)?\s*(минут|час|дн|день|недел|месяц|год|лет)\S*\s+назад")
+    n = pd.to_numeric(r[0], errors="coerce").fillna(1)
+    unit_days = r[1].map({"дн": 1, "день": 1, "недел": 7})
+    unit_secs = r[1].map({"минут": 60, "час": 3600})
+    unit_months = r[1].map({"месяц": 1, "год": 12, "лет": 12})
+    out = out.fillna(day - pd.to_timedelta(n * unit_days, unit="D"))
+    out = out.fillna(now - pd.to_timedelta(n * unit_secs, unit="s"))
+    months = now.dt.year * 12 + now.dt.month - 1 - n * unit_months
+    out = out.fillna(assemble_dates(months // 12, months % 12 + 1, now.dt.day.clip(upper=28), t.index))
+    return out
+def review_keys(df: pd.DataFrame) -> pd.Series:
+    parts = pd.DataFrame({
+        "text": df["review_text"].str.lower(),
+        "name": df["reviewer_name"].str.lower(),
+        "day": df["review_ts"].dt.strftime("%Y-%m-%d"),
+    }).fillna("")
+    h = pd.util.hash_pandas_object(parts, index=False)
+    return h.map("{:016x}".format).where(df["review_text"].notna())
+def postprocess_reviews(df: pd.DataFrame, now: Optional[pd.Timestamp] = None) -> Tuple[pd.DataFrame, Dict[str, int]]:
+    now = now or pd.Timestamp.now()
+    df = df.reindex(columns=OUT_COLUMNS).copy()
+    for c in CLEAN_TEXT_COLUMNS:
+        df[c] = clean_text(df[c])
+    scraped = pd.to_datetime(df["scraped_at"], errors="coerce", format="ISO8601")
+    df["review_ts"] = parse_review_dates(df["review_date"], scraped.fillna(now))
+    df["review_key"] = review_keys(df)
+    is_review = df["review_key"].notna()
+    dup = is_review & df["review_key"].duplicated()
+    card = df["src_row_index"].astype("string") + "|" + df["two_gis_url"].astype("string").fillna("")
+    dup |= df["error"].notna() & ~is_review & card.isin(card[is_review])
+    stats = {"duplicates": int(dup.sum()), "undated": int((is_review & df["review_ts"].isna()).sum())}
+    return df[~dup], stats
+def read_outputs(paths: List[str]) -> pd.DataFrame:
+    files: List[str] = []
+    for p in paths:
+        if os.path.isdir(p):
+            chunks = sorted(f for f in os.listdir(p) if re.fullmatch(r"2gis_reviews_chunk_\d+\.csv", f))
+            files.extend(os.path.join(p, f) for f in chunks)
+        else:
+            files.append(p)
+    frames = []
+    for f in files:
+        if f.endswith(".parquet"):
+            frames.append(pd.read_parquet(f).astype("string"))
+        else:
+            frames.append(pd.read_csv(f, dtype="string", encoding="utf-8-sig", keep_default_na=False, na_values=[""]))
+    if not frames:
+        return pd.DataFrame(columns=OUT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+def run_postprocess(paths: List[str], out_path: str):
+    t0 = time.time()
+    raw = read_outputs(paths)
+    df, stats = postprocess_reviews(raw)
+    df = df.assign(review_ts=df["review_ts"].dt.strftime("%Y-%m-%d %H:%M:%S"))
+    if out_path.endswith(".parquet"):
+        df.to_parquet(out_path, index=False)
+    else:
+        df.to_csv(out_path, index=False, encoding="utf-8-sig")
+    print(f"Постобработка: строк {len(raw)} → {len(df)}, дублей удалено {stats['duplicates']}, "
+          f"без даты {stats['undated']}, {time.time() - t0:.1f} с → {out_path}")
+def card_recall(df: pd.DataFrame) -> pd.DataFrame:
+    df = df[df["two_gis_url"].notna()]
+    if "stop_reason" not in df.columns:
+        df = df.assign(stop_reason=pd.NA)
+    ok = df["error"].isna()
+    g = df.groupby("two_gis_url", sort=False)
+    cards = pd.DataFrame({
+        "hint": pd.to_numeric(g["rating_reviews"].first(), errors="coerce"),
+        "stop_reason": g["stop_reason"].first().fillna("unknown"),
+    })
+    cards["reviews"] = df[ok].groupby("two_gis_url")["review_id"].nunique().reindex(cards.index, fill_value=0)
+    has_hint = cards["hint"] > 0
+    cards["recall"] = (cards["reviews"].clip(upper=cards["hint"]) / cards["hint"]).where(has_hint)
+    return cards
+def run_metrics(path: Optional[str]) -> Optional[Dict[str, Any]]:
+    if METRICS.counters:
+        return {"run": METRICS.run_id, "stages": METRICS.summary(), "counters": dict(METRICS.counters),
+                "elapsed": time.time() - METRICS.started}
+    last = None
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if '"summary"' not in line: continue
+                try: rec = json.loads(line)
+                except ValueError: continue
+                if rec.get("t") == "summary": last = rec
+    return last
+def build_report(paths: List[str], metrics: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    cards = card_recall(read_outputs(paths))
+    hinted = cards[cards["hint"] > 0]
+    expected = int(hinted["hint"].sum())
+    report: Dict[str, Any] = {
+        "run": (metrics or {}).get("run"),
+        "cards": len(cards),
+        "reviews": int(cards["reviews"].sum()),
+        "expected": expected,
+        "recall": round(float(hinted["reviews"].clip(upper=hinted["hint"]).sum()) / expected, 4) if expected else None,
+        "recall_p50": round(float(hinted["recall"].median()), 4) if len(hinted) else None,
+        "cards_below_retry": int((hinted["recall"] < RETRY_BELOW_RECALL).sum()),
+        "stop_reasons": {k: int(v) for k, v in cards["stop_reason"].value_counts().items()},
+    }
+    if metrics:
+        counters = metrics.get("counters") or {}
+        stages = metrics.get("stages") or {}
+        scraped = counters.get("reviews", 0)
+        minutes = (metrics.get("elapsed") or 0) / 60
+        sleep = sum(st["total"] for stage, st in stages.items() if stage.startswith("sleep:"))
+        report.update({
+            "minutes": round(minutes, 2),
+            "reviews_per_min": round(scraped / minutes, 2) if minutes else None,
+            "page_loads_per_review": round(counters.get("page_loads", 0) / scraped, 4) if scraped else None,
+            "sleep_sec": round(sleep, 1),
+            "sleep_sec_per_review": round(sleep / scraped, 4) if scraped else None,
+        })
+    report["worst_cards"] = [
+        {"url": url, "hint": int(c.hint), "reviews": int(c.reviews), "stop_reason": c.stop_reason}
+        for url, c in hinted.sort_values("recall").head(5).iterrows()
+    ]
+    return report
+def compare_report(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float,
+                   higher: Tuple[str, ...] = ("reviews_per_min",),
+                   lower: Tuple[str, ...] = ("page_loads_per_review", "sleep_sec_per_review")) -> List[str]:
+    problems = []
+    for key in higher:
+        old, new = baseline.get(key), report.get(key)
+        if old and new is not None and new < old * (1 - tolerance):
+            problems.append(f"{key}: {new} < {old} (-{(1 - new / old) * 100:.1f}%)")
+    for key in lower:
+        old, new = baseline.get(key), report.get(key)
+        if old and new is not None and new > old * (1 + tolerance):
+            problems.append(f"{key}: {new} > {old} (+{(new / old - 1) * 100:.1f}%)")
+    old, new = baseline.get("recall"), report.get("recall")
+    if old is not None and new is not None and new < old - min(0.05, tolerance / 3):
+        problems.append(f"recall: {new} < {old}")
+    return problems
+def run_report(paths: List[str], metrics_path: Optional[str] = None, baseline_path: Optional[str] = None,
+               save_baseline: Optional[str] = None) -> List[str]:
+    report = build_report(paths, run_metrics(metrics_path or METRICS_PATH))
+    print("\n=== Отчёт по запуску ===")
+    for k, v in report.items():
+        if k == "worst_cards": continue
+        print(f"  {k:22s} {v}")
+    for c in report["worst_cards"]:
+        print(f"  худшая: {c['reviews']}/{c['hint']} ({c['stop_reason']}) {c['url']}")
+    if REPORT_PATH:
+        with open(REPORT_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": round(time.time(), 3), **report}, ensure_ascii=False) + "\n")
+    if save_baseline:
+        with open(save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Baseline сохранён: {save_baseline}")
+    baseline_path = baseline_path or REPORT_BASELINE
+    if not baseline_path or not os.path.exists(baseline_path) or baseline_path == save_baseline:
+        return []
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    problems = compare_report(report, baseline, REPORT_TOLERANCE)
+    if problems:
+        print(f"!! Хуже baseline {baseline_path}:")
+        for p in problems: print(f"   - {p}")
+    else:
+        print(f"Не хуже baseline {baseline_path} (допуск {REPORT_TOLERANCE:.0%})")
+    return problems
+def cell(v):
+    if v is None or (isinstance(v, float) and v != v): return None
+    if isinstance(v, str) and not v.strip(): return None
+    return v
+def coord(v) -> Optional[float]:
+    if v is None: return None
+    try: return float(str(v).replace(",", "."))
+    except ValueError: return None
+def count(v) -> Optional[int]:
+    n = coord(v)
+    return int(n) if n is not None and n == n and n >= 0 else None
+def read_row(values: tuple, site: Optional[str] = None) -> Dict[str, Any]:
+    id_full, name, phones, lat, lon, reviews = (cell(v) for v in values)
+    if isinstance(id_full, float) and id_full.is_integer():
+        id_full = int(id_full)
+    id_full = str(id_full).strip() if id_full is not None else None
+    return {
+        "id_pref": id_prefix_from_full(id_full) if id_full else None,
+        "name":    str(name).strip() if name is not None else None,
+        "phones":  str(phones).strip() if phones is not None else None,
+        "lat":     coord(lat),
+        "lon":     coord(lon),
+        "reviews": count(reviews),
+        "site":    site or default_site(),
+    }
+def scraped_at(ts: Optional[float] = None) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(ts))
+def error_row(i, fields: Dict[str, Any], url: Optional[str], total_hint: Optional[int], error: str,
+              stop_reason: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "src_row_index": i, "firm_id": fields["id_pref"], "org_name": fields["name"],
+        "two_gis_url": url,
+        "rating_value": None,
+        "rating_reviews": total_hint,
+        "review_id": None, "review_date": None, "review_rating": None,
+        "reviewer_name": None, "reviewer_total_reviews": None,
+        "reviewer_profile_url": None,
+        "review_text": None, "likes_count": None, "photos_count": None,
+        "photos_urls": None, "owner_reply_text": None, "owner_reply_date": None,
+        "review_link": None, "error": error, "stop_reason": stop_reason, "scraped_at": scraped_at(),
+    }
+class SeenCards:
+    def __init__(self):
+        self.urls: set[str] = set()
+        self.lock = threading.Lock()
+    def __contains__(self, url: str) -> bool:
+        with self.lock:
+            return url in self.urls
+    def add(self, url: str):
+        with self.lock:
+            self.urls.add(url)
+class Journal:
+    def __init__(self, path: str, resume: bool, excel: Optional[str] = None):
+        self.path = path
+        self.excel = excel
+        self.lock = threading.Lock()
+        self.done_rows: Dict[Any, List[Dict[str, Any]]] = {}
+        self.done_cards: Dict[Tuple[Any, str], List[Dict[str, Any]]] = {}
+        if resume and os.path.exists(path):
+            self.load()
+        self.f = open(path, "a" if resume else "w", encoding="utf-8")
+        self.append({"t": "start", "excel": excel, "ts": time.time()})
+    def load(self):
+        cards: Dict[Tuple[Any, str], List[Dict[str, Any]]] = {}
+        row_cards: Dict[Any, List[str]] = {}
+        done: List[Any] = []
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                t = rec.get("t")
+                if t == "start" and self.excel and rec.get("excel") != self.excel:
+                    raise SystemExit(f"!! Журнал {self.path} записан для {rec.get('excel')}, а не {self.excel}: "
+                                     f"продолжение невозможно. Запустите без --resume или укажите другой JOURNAL_PATH.")
+                if t == "card":
+                    key = (rec["row"], rec["url"])
+                    if key not in cards:
+                        row_cards.setdefault(rec["row"], []).append(rec["url"])
+                    cards[key] = rec["rows"]
+                elif t == "row":
+                    done.append(rec["row"])
+        for key, rows in cards.items():
+            uniq, seen = [], set()
+            for r in rows:
+                rid = r.get("review_id")
+                if rid is not None and rid in seen: continue
+                seen.add(rid); uniq.append(r)
+            self.done_cards[key] = uniq
+        for i in done:
+            self.done_rows[i] = [r for url in row_cards.get(i, []) for r in self.done_cards[(i, url)]]
+        log(f"Журнал {self.path}: готово строк {len(self.done_rows)}, карточек {len(self.done_cards)}")
+    def append(self, rec: Dict[str, Any]):
+        line = json.dumps(rec, ensure_ascii=False, default=str)
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+            os.fsync(self.f.fileno())
+    def card(self, i, url: str, rows: List[Dict[str, Any]]):
+        self.append({"t": "card", "row": i, "url": url, "rows": rows})
+    def row(self, i):
+        self.append({"t": "row", "row": i})
+    def close(self):
+        with self.lock:
+            self.f.close()
+def journal_source(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.loads(f.readline()).get("excel")
+    except (OSError, ValueError, AttributeError):
+        return None
+class RunState:
+    def __init__(self, journal: Journal):
+        self.seen_card_urls = SeenCards()
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.retries: List[Tuple[Any, Dict[str, Any], str, List[Dict[str, Any]]]] = []
+        for (_, url) in journal.done_cards:
+            self.seen_card_urls.add(url)
+    def defer(self, i, fields: Dict[str, Any], url: str, rows: List[Dict[str, Any]]):
+        with self.lock:
+            self.retries.append((i, fields, url, rows))
+        METRICS.inc("cards_deferred")
+    def deferred(self, i, fields: Dict[str, Any]) -> bool:
+        with self.lock:
+            return any(r[0] == i and r[1] == fields for r in self.retries)
+def process_tree_rss_mb(pid: int) -> Optional[float]:
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            root = psutil.Process(pid)
+            procs = [root] + root.children(recursive=True)
+        except psutil.Error:
+            return None
+        total = 0
+        for p in procs:
+            try: total += p.memory_info().rss
+            except psutil.Error: pass
+        return total / 1048576
+    if not os.path.isdir("/proc"):
+        return None
+    children: Dict[int, List[int]] = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit(): continue
+        try:
+            with open(f"/proc/{name}/stat", encoding="utf-8") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(name))
+    total, todo = 0, [pid]
+    while todo:
+        p = todo.pop()
+        todo.extend(children.get(p, []))
+        try:
+            with open(f"/proc/{p}/statm", encoding="utf-8") as f:
+                total += int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+    return total / 1048576 if total else None
+class DriverSupervisor:
+    def __init__(self, profile_dir: str, name: str = "браузер", attach: bool = False):
+        self.profile_dir = profile_dir
+        self.name = name
+        self.attach = attach
+        self.attached = False
+        self.driver = None
+        self.cards = 0
+        self.restarts = 0
+    def start(self):
+        self.driver = attach_chrome() if self.attach else None
+        self.attached = self.driver is not None
+        if self.driver is None:
+            self.driver = start_chrome_with_fallback(self.profile_dir)
+        self.driver.set_page_load_timeout(30)
+        self.driver.set_script_timeout(GROWTH_WAIT_TIMEOUT + 10)
+        self.cards = 0
+    def quit(self):
+        if self.driver is None: return
+        try: self.driver.quit()
+        except Exception: pass
+        self.driver = None
+    def restart(self, reason: str):
+        log(f"  ↻ {self.name}: перезапуск ({reason})")
+        METRICS.inc("browser_restarts")
+        self.restarts += 1
+        self.quit()
+        self.start()
+    def alive(self) -> bool:
+        if self.driver is None: return False
+        try:
+            self.driver.execute_script("return 1;")
+            return True
+        except Exception:
+            return False
+    def ensure_alive(self):
+        if not self.alive():
+            self.restart("сессия недоступна")
+    def memory_mb(self) -> Optional[float]:
+        try:
+            pid = self.driver.service.process.pid
+        except AttributeError:
+            return None
+        return process_tree_rss_mb(pid)
+    def card_done(self):
+        self.cards += 1
+        if self.attached:
+            return
+        if RECYCLE_AFTER_CARDS and self.cards >= RECYCLE_AFTER_CARDS:
+            self.restart(f"плановый, после {self.cards} карточек")
+            return
+        mem = self.memory_mb() if RENDERER_MEM_LIMIT_MB else None
+        if mem and mem > RENDERER_MEM_LIMIT_MB:
+            self.restart(f"память браузера {mem:.0f} МБ > {RENDERER_MEM_LIMIT_MB} МБ")
+_debug_saved = 0
+_debug_lock = threading.Lock()
+def save_debug(driver, name: str):
+    global _debug_saved
+    with _debug_lock:
+        if _debug_saved >= DEBUG_MAX_FILES or random.random() >= DEBUG_SAMPLE_RATE:
+            return
+        _debug_saved += 1
+    os.makedirs(DEBUG_DIR, exist_ok=True)
+    path = os.path.join(DEBUG_DIR, name)
+    try:
+        with gzip.open(path + ".html.gz", "wt", encoding="utf-8", compresslevel=6) as f:
+            f.write(driver.page_source)
+        driver.save_screenshot(path + ".png")
+    except Exception as e:
+        log(f"    ! debug не сохранён: {e}")
         return
-    df = pd.read_excel(EXCEL_PATH)
-    print("=== Старт парсера 2ГИС (отзывы) ===")
-    print(f"Excel загружен: {EXCEL_PATH}, строк: {len(df)}")
-    print(f"Колонки: {list(df.columns)}")
-    id_col   = pick_col(df, ID_COLS)
-    name_col = pick_col(df, NAME_COLS)
-    phone_col= pick_col(df, PHONE_COLS)
-    lat_col  = pick_col(df, LAT_COLS)
-    lon_col  = pick_col(df, LON_COLS)
-    print(f"Опознаны колонки → id:{id_col}, name:{name_col}, phone:{phone_col}, lat:{lat_col}, lon:{lon_col}")
-    driver = start_chrome_with_fallback()
-    driver.set_page_load_timeout(30)
-    print("Браузер запущен.\n")
+    log(f"    ⚠ debug сохранён: {path}.html.gz/png")
+def review_rows(i, fields: Dict[str, Any], url: str, total_hint: Optional[int],
+                reviews: List[Dict[str, Any]], stop_reason: Optional[str], at: Optional[str] = None) -> List[Dict[str, Any]]:
+    at = at or scraped_at()
+    return [{
+        "src_row_index": i, "firm_id": fields["id_pref"], "org_name": fields["name"],
+        "two_gis_url": url,
+        "rating_value": None,
+        "rating_reviews": total_hint,
+        **r, "error": None, "stop_reason": stop_reason, "scraped_at": at,
+    } for r in reviews]
+def scrape_card(driver, i, fields: Dict[str, Any], base_url: str, hits: int,
+                state: RunState) -> Tuple[str, Optional[str], List[Dict[str, Any]], int]:
+    current = driver.current_url or ""
+    if not (card_base_url(current) == card_base_url(base_url) and "/reviews" in current):
+        reset_capture(driver)
+        if not stable_get(driver, reviews_tab_url(base_url), retries=3):
+            log(f"    - не открылось: {base_url}")
+            return "failed", None, [], 0
+    final_url = card_base_url(driver.current_url)
+    if not final_url:
+        log("    - редирект на главную, пропуск")
+        return "home", None, [], 0
+    state.seen_card_urls.add(final_url)
+    log(f"    Открыта карточка: {driver.current_url}")
+    jumped = "/reviews" in driver.current_url
+    if not jumped and stable_get(driver, final_url + "/reviews", retries=1, base_sleep=0.5):
+        jumped = "/reviews" in driver.current_url
+    if not jumped:
+        el = safe_find(driver, By.XPATH, "//div[@role='tab' and contains(normalize-space(),'Отзывы')]")
+        if el:
+            try:
+                run_js(driver, "scroll_into_view", "arguments[0].scrollIntoView({block:'center'});", el)
+                pause(0.15, "tab_click"); el.click(); pause(0.5, "tab_click")
+                ActionChains(driver).move_by_offset(random.randint(-30, 30), random.randint(-30, 30)).perform()
+            except Exception:
+                pass
+    try:
+        body = driver.find_element(By.TAG_NAME, "body")
+        body.send_keys(Keys.END); pause(0.2, "keys")
+        body.send_keys(Keys.HOME); pause(0.15, "keys")
+    except Exception:
+        pass
+    total_hint = extract_total_hint(driver)
+    index = get_review_index()
+    card_id = card_id_from_url(final_url)
+    cache = get_resolve_cache()
+    if cache and card_id and total_hint is not None:
+        cache.put("hint_cache", card_id, total_hint)
+    max_steps, hard_timeout, use_api = card_budget(total_hint)
+    if total_hint:
+        log(f"    Бюджет карточки: шагов {max_steps}, {hard_timeout:.0f} с{', API' if use_api else ''}")
+    known = index.known(card_id) if INCREMENTAL and index and card_id else None
+    if known is not None and not known.ids:
+        known = None
+    fetched = None
+    if REVIEWS_ENGINE == "api" or use_api:
+        fetched = fetch_reviews_api(driver, total_hint, known)
+        if fetched is None:
+            log("    • API недоступен — переходим к скроллингу")
+    if fetched is None:
+        fetched = crawl_reviews_incremental(driver, total_hint, known, max_steps, hard_timeout)
+    reviews, stop_reason = fetched
+    METRICS.inc(f"stop_{stop_reason}")
+    incomplete = bool(total_hint and not known and len(reviews) < RETRY_BELOW_RECALL * total_hint)
+    finished = stop_reason in ("hint_reached", "end") or (stop_reason == "stagnation" and total_hint is not None)
+    if index and card_id and reviews:
+        index.add(card_id, reviews)
+        if CARD_INDEX_MAX_AGE_H and not known and finished and not incomplete:
+            ids = [card_id] + [c for c in [card_id_from_url(base_url)] if c]
+            index.put_card(ids, final_url, total_hint, reviews)
+    card_rows: List[Dict[str, Any]] = []
+    if not reviews and known:
+        log(f"    Новых отзывов нет (известно: {len(known.ids)})")
+    elif not reviews:
+        save_debug(driver, f"debug_{i}_{hits}")
+        card_rows.append(error_row(i, fields, final_url, total_hint, "0 reviews (virtualized)", stop_reason))
+        log("    Отзывов: 0")
+    else:
+        card_rows = review_rows(i, fields, final_url, total_hint, [r.as_dict() for r in reviews], stop_reason)
+        if incomplete:
+            save_debug(driver, f"debug_{i}_{hits}_incomplete")
+        log(f"    Отзывов собрано: {len(reviews)} (ожидалось: {total_hint or '—'}, стоп: {stop_reason})")
+    return ("incomplete" if incomplete else "ok"), final_url, card_rows, len(reviews or [])
+def process_row(sup: DriverSupervisor, i, n_total: int, fields: Dict[str, Any], state: RunState) -> List[Dict[str, Any]]:
+    seen_card_urls = state.seen_card_urls
+    id_pref, name, phones = fields["id_pref"], fields["name"], fields["phones"]
+    site = fields.get("site") or default_site()
+    print(f"[{i+1}/{n_total}] ► {name or id_pref or phones}")
     out_rows: List[Dict[str, Any]] = []
-    processed_rows = 0
-    chunk_idx = 0
-    seen_card_urls: set[str] = set()
+    cache = get_resolve_cache()
+    row_key = row_cache_key(fields)
+    cached_cards = cache.get("row_cache", row_key) if cache else None
+    candidates: List[str] = []
+    if cached_cards:
+        candidates += cached_cards
+        print(f"  Карточки из кэша: {len(cached_cards)}")
+    elif id_pref and indexed_card(firm_url(id_pref, site)):
+        candidates.append(firm_url(id_pref, site))
+        print(f"  Карточка по id из индекса: {id_pref}")
+    else:
+        candidates += resolve_candidates(sup.driver, fields)
+    uniq, seen = [], set()
+    for u in candidates:
+        if u.startswith(site + "/") and u not in seen:
+            seen.add(u); uniq.append(u)
+    candidates = uniq
+    print(f"  Итого уникальных карточек: {len(candidates)}")
+    total_reviews_for_row = 0
+    hits = 0
+    resolved: List[str] = []
+    for base_url in candidates:
+        done = state.journal.done_cards.get((i, base_url))
+        if done is not None:
+            log(f"    - из журнала: {base_url} (строк {len(done)})")
+            out_rows.extend(done)
+            resolved.append(base_url)
+            hits += 1
+            continue
+        indexed = indexed_card(base_url)
+        if indexed is not None:
+            url, total_hint, reviews, ts = indexed
+            card_rows = review_rows(i, fields, url, total_hint, reviews, "card_index", scraped_at(ts))
+            log(f"    - из индекса карточек: {url} (отзывов {len(reviews)})")
+            state.journal.card(i, base_url, card_rows)
+            METRICS.inc("cards_indexed")
+            out_rows.extend(card_rows)
+            resolved.append(url)
+            total_reviews_for_row += len(reviews)
+            hits += 1
+            continue
+        if base_url in seen_card_urls:
+            log(f"    - уже посещали: {base_url}")
+            resolved.append(base_url)
+            continue
+        started = time.time()
+        for attempt in (1, 2):
+            try:
+                status, final_url, card_rows, n_reviews = scrape_card(sup.driver, i, fields, base_url, hits, state)
+            except Exception as e:
+                log(f"    ! ошибка на карточке: {type(e).__name__}: {(str(e).splitlines() or [''])[0]}")
+                status, final_url, card_rows, n_reviews = "error", None, [], 0
+            if (status in ("ok", "incomplete") and n_reviews) or status == "home" or sup.alive():
+                break
+            sup.restart("сессия умерла на карточке")
+            if attempt == 1:
+                log(f"    ↻ повтор карточки: {base_url}")
+        if status in ("failed", "error"):
+            state.defer(i, fields, base_url, [])
+        if status not in ("ok", "incomplete"):
+            continue
+        if status == "incomplete":
+            state.defer(i, fields, base_url, card_rows)
+        resolved.append(final_url)
+        state.journal.card(i, base_url, card_rows)
+        METRICS.inc("cards")
+        METRICS.inc("reviews", n_reviews)
+        out_rows.extend(card_rows)
+        total_reviews_for_row += n_reviews
+        hits += 1
+        sup.card_done()
+        if time.time() - started > PER_CARD_HARD_TIMEOUT:
+            log("    • пер-карточный таймаут — к след.")
+            break
+        pause(random.uniform(0.2, 0.4), "between_cards")
+    if cache:
+        if resolved:
+            cache.put("row_cache", row_key, list(dict.fromkeys(resolved)))
+        elif cached_cards:
+            cache.delete("row_cache", row_key)
+    print(f"  ► ИТОГО по строке: карточек {hits}, отзывов {total_reviews_for_row}")
+    return out_rows
+def worker_loop(wid: int, sched: DomainScheduler, results: "queue.Queue", stop: threading.Event):
+    sup = DriverSupervisor(worker_profile_dir(wid), f"воркер {wid}", attach=wid == 0)
     try:
-        for i, row in df.iterrows():
-            t0 = time.time()
-            id_full = str(row[id_col]).strip() if id_col and pd.notna(row[id_col]) else None
-            id_pref = id_prefix_from_full(id_full) if id_full else None
-            name    = str(row[name_col]).strip() if name_col and pd.notna(row[name_col]) else None
-            phones  = str(row[phone_col]).strip() if phone_col and pd.notna(row[phone_col]) else None
-            lat     = float(row[lat_col]) if lat_col and pd.notna(row[lat_col]) else None
-            lon     = float(row[lon_col]) if lon_col and pd.notna(row[lon_col]) else None
-            print(f"[{i+1}/{len(df)}] ► {name or id_pref or phones}")
-            candidates: List[str] = []
-            if phones:
-                found = open_candidates_by_phone(driver, phones, lon, lat)
-                found = filter_by_prefix(found, id_pref)
-                print(f"  Кандидаты по телефону (после фильтра по prefix): {len(found)}")
-                candidates += found
-            if id_pref:
-                candidates += open_candidates_by_id(id_pref)
-                print("  Добавлены кандидаты по id-prefix (firm/branch).")
-            if name:
-                found = open_candidates_by_name(driver, name, lon, lat)
-                found = filter_by_prefix(found, id_pref)
-                print(f"  Кандидаты по name (после фильтра по prefix): {len(found)}")
-                candidates += found
-            uniq, seen = [], set()
-            for u in candidates:
-                if u.startswith(f"{BASE_DOMAIN}/{CITY_SLUG}/") and u not in seen:
-                    seen.add(u); uniq.append(u)
-            candidates = uniq
-            print(f"  Итого уникальных карточек: {len(candidates)}")
-            total_reviews_for_row = 0
-            hits = 0
-            for base_url in candidates:
-                if base_url in seen_card_urls:
-                    log(f"    - уже посещали: {base_url}")
-                    continue
-                started = time.time()
-                if not stable_get(driver, base_url, retries=3):
-                    log(f"    - не открылось: {base_url}")
-                    continue
-                final_url = driver.current_url
-                if final_url.rstrip("/") == f"{BASE_DOMAIN}/{CITY_SLUG}":
-                    log("    - редирект на главную, пропуск")
-                    continue
-                seen_card_urls.add(final_url)
-                log(f"    Открыта карточка: {final_url}")
-                jumped = False
-                for suf in ("/tab/reviews", "/reviews"):
-                    if stable_get(driver, final_url.rstrip("/") + suf, retries=2, base_sleep=0.5):
-                        jumped = True
-                        log(f"    Перейдено на: {driver.current_url}")
-                        break
-                if not jumped:
-                    el = safe_find(driver, By.XPATH, "//div[@role='tab' and contains(normalize-space(),'Отзывы')]")
-                    if el:
-                        try:
-                            driver.execute_script("arguments[0].scrollIntoView({block:'center'});", el)
-                            time.sleep(0.15); el.click(); time.sleep(0.5)
-                            ActionChains(driver).move_by_offset(random.randint(-30, 30), random.randint(-30, 30)).perform()
-                        except Exception:
-                            pass
-                try:
-                    body = driver.find_element(By.TAG_NAME, "body")
-                    body.send_keys(Keys.END); time.sleep(0.2)
-                    body.send_keys(Keys.HOME); time.sleep(0.15)
-                except Exception:
-                    pass
-                total_hint = extract_total_hint(driver)
-                reviews = crawl_reviews_incremental(driver, total_hint)
-                if not reviews and total_hint and total_hint > 0:
-                    reviews = crawl_reviews_incremental(driver, total_hint)
-                if not reviews:
-                    with open(f"debug_{i}_{hits}.html", "w", encoding="utf-8") as f:
-                        f.write(driver.page_source)
-                    try: driver.save_screenshot(f"debug_{i}_{hits}.png")
-                    except Exception: pass
-                    log(f"    ⚠ debug сохранён: debug_{i}_{hits}.html/png")
-                    out_rows.append({
-                        "src_row_index": i, "firm_id": id_pref, "org_name": name,
-                        "two_gis_url": final_url,
-                        "rating_value": None,
-                        "rating_reviews": total_hint,
-                        "review_id": None, "review_date": None, "review_rating": None,
-                        "reviewer_name": None, "reviewer_total_reviews": None,
-                        "reviewer_profile_url": None,
-                        "review_text": None, "likes_count": None, "photos_count": None,
-                        "photos_urls": None, "owner_reply_text": None, "owner_reply_date": None,
-                        "review_link": None, "error": "0 reviews (virtualized)",
-                    })
-                    log("    Отзывов: 0")
-                else:
-                    for r in reviews:
-                        out_rows.append({
-                            "src_row_index": i, "firm_id": id_pref, "org_name": name,
-                            "two_gis_url": final_url,
-                            "rating_value": None,
-                            "rating_reviews": total_hint,
-                            **r, "error": None,
-                        })
-                    total_reviews_for_row += len(reviews)
-                    if total_hint and len(reviews) < total_hint:
-                        with open(f"debug_{i}_{hits}_incomplete.html", "w", encoding="utf-8") as f:
-                            f.write(driver.page_source)
-                        try: driver.save_screenshot(f"debug_{i}_{hits}_incomplete.png")
-                        except Exception: pass
-                        log(f"    ⚠ debug сохранён (неполный сбор): debug_{i}_{hits}_incomplete.html/png")
-                    log(f"    Отзывов собрано: {len(reviews)} (ожидалось: {total_hint or '—'})")
-                hits += 1
-                if time.time() - started > PER_CARD_HARD_TIMEOUT:
-                    log("    • пер-карточный таймаут — к след.")
+        sup.start()
+    except Exception as e:
+        log(f"!! Воркер {wid}: браузер не запустился: {e}")
+        results.put(("exit", wid, None))
+        return
+    log(f"Воркер {wid}: браузер запущен.")
+    try:
+        while not stop.is_set():
+            got = sched.get()
+            if got is None:
+                break
+            delay, (run, pos, i, values) = got
+            left = budget_left()
+            if left is not None and left <= 0:
+                log(f"Воркер {wid}: бюджет времени исчерпан — стоп")
+                break
+            fields = read_row(values, run.site)
+            if delay:
+                pause(delay, "rate_limit")
+            try:
+                sup.ensure_alive()
+                with METRICS.timed("row"):
+                    rows = process_row(sup, i, run.n_total, fields, run.state)
+                METRICS.inc("rows")
+                run.journal.row(i)
+            except Exception as e:
+                log(f"!! Воркер {wid}: ошибка на строке {i}: {e}")
+                rows = [error_row(i, fields, None, None, f"exception: {e}")]
+            results.put(("row", (run.k, pos), rows))
+            plan_done((run.k, pos))
+    finally:
+        sup.quit()
+        results.put(("exit", wid, None))
+INPUT_COLS = (("id", ID_COLS), ("name", NAME_COLS), ("phone", PHONE_COLS), ("lat", LAT_COLS), ("lon", LON_COLS),
+              ("reviews", REVIEWS_COLS))
+def in_shard(i: int, id_value) -> bool:
+    if ROW_RANGE and not (ROW_RANGE[0] <= i and (ROW_RANGE[1] is None or i < ROW_RANGE[1])):
+        return False
+    if SHARD:
+        k, n = SHARD
+        key = cell(id_value)
+        return zlib.crc32(str(i if key is None else key).encode("utf-8")) % n == k
+    return True
+def shard_tag() -> str:
+    parts = []
+    if ROW_RANGE: parts.append(f"rows{ROW_RANGE[0]}-{'' if ROW_RANGE[1] is None else ROW_RANGE[1]}")
+    if SHARD: parts.append(f"shard{SHARD[0]}of{SHARD[1]}")
+    return "_".join(parts)
+class InputReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.kind = os.path.splitext(path)[1].lower().lstrip(".")
+        self.header = [str(h).strip() if h is not None else "" for h in self.read_header()]
+        self.cols = {key: pick_col(self.header, cands) for key, cands in INPUT_COLS}
+        self.names = [c for c in self.cols.values() if c]
+        if self.kind == "parquet":
+            self.idx = [self.names.index(c) if c else None for c in self.cols.values()]
+        else:
+            self.idx = [self.header.index(c) if c else None for c in self.cols.values()]
+    def read_header(self) -> List[Any]:
+        if self.kind == "csv":
+            with open(self.path, newline="", encoding="utf-8-sig") as f:
+                return next(csv.reader(f, self.dialect(f)), [])
+        if self.kind == "parquet":
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(self.path).schema_arrow.names
+        import openpyxl
+        wb = openpyxl.load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            return list(next(wb.active.iter_rows(max_row=1, values_only=True), ()))
+        finally:
+            wb.close()
+    @staticmethod
+    def dialect(f):
+        sample = f.read(65536)
+        f.seek(0)
+        try: return csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error: return csv.excel
+    def raw_rows(self) -> Iterator[tuple]:
+        if self.kind == "csv":
+            with open(self.path, newline="", encoding="utf-8-sig") as f:
+                reader = csv.reader(f, self.dialect(f))
+                next(reader, None)
+                yield from reader
+        elif self.kind == "parquet":
+            import pyarrow.parquet as pq
+            if not self.names: return
+            for batch in pq.ParquetFile(self.path).iter_batches(columns=self.names):
+                yield from zip(*(col.to_pylist() for col in batch.columns))
+        else:
+            import openpyxl
+            wb = openpyxl.load_workbook(self.path, read_only=True, data_only=True)
+            try:
+                max_col = max((j for j in self.idx if j is not None), default=0) + 1
+                yield from wb.active.iter_rows(min_row=2, max_col=max_col, values_only=True)
+            finally:
+                wb.close()
+    def __iter__(self) -> Iterator[Tuple[int, tuple]]:
+        end = ROW_RANGE[1] if ROW_RANGE else None
+        for i, r in enumerate(self.raw_rows()):
+            if end is not None and i >= end:
+                break
+            values = tuple(r[j] if j is not None and j < len(r) else None for j in self.idx)
+            if all(cell(v) is None for v in values) or not in_shard(i, values[0]):
+                continue
+            yield i, values
+def open_input(path: str) -> Optional[InputReader]:
+    if not os.path.exists(path):
+        print(f"ОШИБКА: файл не найден: {path}", flush=True)
+        return None
+    try:
+        reader = InputReader(path)
+    except ImportError as e:
+        print(f"ОШИБКА: для {path} нужен модуль {e.name}", flush=True)
+        return None
+    cols = reader.cols
+    print("=== Старт парсера 2ГИС (отзывы) ===")
+    print(f"Вход: {path} ({reader.kind}), колонок: {len(reader.header)}")
+    print(f"Опознаны колонки → id:{cols['id']}, name:{cols['name']}, phone:{cols['phone']}, lat:{cols['lat']}, lon:{cols['lon']}, reviews:{cols['reviews']}")
+    if ROW_RANGE or SHARD:
+        print(f"Доля входа: {shard_tag()}")
+    return reader
+class JobQueue:
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=DELETE")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS jobs (pos INTEGER PRIMARY KEY, row TEXT NOT NULL, fields TEXT NOT NULL, "
+                              "status TEXT NOT NULL DEFAULT 'queued', attempts INTEGER NOT NULL DEFAULT 0, "
+                              "worker TEXT, lease_until REAL, result TEXT, error TEXT, updated REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS domain_rate (domain TEXT PRIMARY KEY, next_at REAL NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS queue_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute("INSERT OR IGNORE INTO queue_meta (key, value) VALUES ('id', ?)", (os.urandom(8).hex(),))
+            self.queue_id = self.conn.execute("SELECT value FROM queue_meta WHERE key = 'id'").fetchone()[0]
+    @contextmanager
+    def tx(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+    def enqueue(self, jobs: List[Tuple[int, Any, Dict[str, Any]]], source: str) -> int:
+        new = [(pos, json.dumps(i), json.dumps(fields, ensure_ascii=False)) for pos, i, fields in jobs]
+        with self.tx() as c:
+            r = c.execute("SELECT value FROM queue_meta WHERE key = 'input'").fetchone()
+            if r and r[0] != source:
+                raise ValueError(f"очередь заполнена для другого входа: {r[0]}")
+            old = {pos: (i, fields) for pos, i, fields in c.execute("SELECT pos, row, fields FROM jobs")}
+            changed = [pos for pos, i, fields in new if pos in old and old[pos] != (i, fields)]
+            if changed:
+                raise ValueError(f"строки входа изменились с прошлой постановки (задачи {', '.join(map(str, changed[:5]))}"
+                                 f"{' …' if len(changed) > 5 else ''})")
+            c.execute("INSERT OR IGNORE INTO queue_meta (key, value) VALUES ('input', ?)", (source,))
+            before = c.total_changes
+            c.executemany("INSERT OR IGNORE INTO jobs (pos, row, fields, updated) VALUES (?, ?, ?, ?)",
+                          [(pos, i, fields, time.time()) for pos, i, fields in new])
+            return c.total_changes - before
+    def lease(self, worker: str) -> Optional[Tuple[int, Any, Dict[str, Any], int]]:
+        now = time.time()
+        with self.tx() as c:
+            c.execute("UPDATE jobs SET status = 'failed', error = 'lease expired', updated = ? "
+                      "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, JOB_MAX_ATTEMPTS))
+            r = c.execute("SELECT pos, row, fields, attempts FROM jobs WHERE status = 'queued' "
+                          "OR (status = 'leased' AND lease_until < ?) ORDER BY pos LIMIT 1", (now,)).fetchone()
+            if not r:
+                return None
+            c.execute("UPDATE jobs SET status = 'leased', worker = ?, attempts = attempts + 1, lease_until = ?, updated = ? "
+                      "WHERE pos = ?", (worker, now + JOB_VISIBILITY_TIMEOUT, now, r[0]))
+        return r[0], json.loads(r[1]), json.loads(r[2]), r[3] + 1
+    def touch(self, pos: int, worker: str):
+        with self.tx() as c:
+            c.execute("UPDATE jobs SET lease_until = ? WHERE pos = ? AND status IN ('leased', 'retry') AND worker = ?",
+                      (time.time() + JOB_VISIBILITY_TIMEOUT, pos, worker))
+    def complete(self, pos: int, rows: List[Dict[str, Any]], retry: bool = False):
+        now = time.time()
+        with self.tx() as c:
+            c.execute("UPDATE jobs SET status = ?, result = ?, error = NULL, lease_until = ?, updated = ? "
+                      "WHERE pos = ? AND status NOT IN ('done', 'retry')",
+                      ("retry" if retry else "done", json.dumps(rows, ensure_ascii=False, default=str),
+                       now + JOB_VISIBILITY_TIMEOUT if retry else None, now, pos))
+    def retry_jobs(self, name: str) -> Dict[Tuple[str, str], Tuple[int, str]]:
+        prefix = f"{name}/"
+        with self.lock:
+            rows = self.conn.execute("SELECT pos, row, fields, worker FROM jobs WHERE status = 'retry' "
+                                     "AND substr(worker, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        return {(i, fields): (pos, worker) for pos, i, fields, worker in rows}
+    def finish_retry(self, pos: int, rows: List[Dict[str, Any]]):
+        with self.tx() as c:
+            r = c.execute("SELECT result FROM jobs WHERE pos = ? AND status = 'retry'", (pos,)).fetchone()
+            if not r: return
+            result = (json.loads(r[0]) if r[0] else []) + rows
+            c.execute("UPDATE jobs SET status = 'done', result = ?, lease_until = NULL, updated = ? WHERE pos = ?",
+                      (json.dumps(result, ensure_ascii=False, default=str), time.time(), pos))
+    def release_retries(self):
+        with self.tx() as c:
+            c.execute("UPDATE jobs SET status = 'done', lease_until = NULL, updated = ? "
+                      "WHERE status = 'retry' AND lease_until < ?", (time.time(), time.time()))
+    def fail(self, pos: int, error: str):
+        with self.tx() as c:
+            c.execute("UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                      "error = ?, lease_until = NULL, updated = ? WHERE pos = ? AND status = 'leased'",
+                      (JOB_MAX_ATTEMPTS, error, time.time(), pos))
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+    def results(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT pos, row, fields, status, result, error FROM jobs ORDER BY pos").fetchall()
+        for pos, i, fields, status, result, error in rows:
+            yield pos, json.loads(i), json.loads(fields), status, json.loads(result) if result else None, error
+    def rate_slot(self, domain: str, interval: float) -> float:
+        with self.tx() as c:
+            now = time.time()
+            r = c.execute("SELECT next_at FROM domain_rate WHERE domain = ?", (domain,)).fetchone()
+            at = max(now, r[0] if r else 0.0)
+            c.execute("INSERT OR REPLACE INTO domain_rate (domain, next_at) VALUES (?, ?)",
+                      (domain, at + interval + random.uniform(0.1, 0.3)))
+        return at - now
+class SharedRateLimiter:
+    def __init__(self, jobs: JobQueue):
+        self.jobs = jobs
+    def wait(self, site: str):
+        domain = site_domain(site)
+        delay = self.jobs.rate_slot(domain, 60.0 / max(1, domain_rate(domain)))
+        if delay > 0:
+            pause(delay, "rate_limit")
+def queue_worker(wid: int, name: str, profile_dir: str, n_total: int, jobs: JobQueue, limiter: SharedRateLimiter,
+                 state: RunState, active: Dict[int, str], stop: threading.Event):
+    lease_name = f"{name}/{wid}"
+    sup = DriverSupervisor(profile_dir, f"воркер {lease_name}")
+    try:
+        sup.start()
+    except Exception as e:
+        log(f"!! Воркер {lease_name}: браузер не запустился: {e}")
+        return
+    try:
+        while not stop.is_set():
+            job = jobs.lease(lease_name)
+            if job is None:
+                if not jobs.counts().get("leased"):
                     break
-                time.sleep(random.uniform(0.2, 0.4))
-            processed_rows += 1
-            if processed_rows % CHUNK_SIZE == 0:
-                save_progress(out_rows, processed_rows // CHUNK_SIZE)
-            elapsed = time.time() - t0
-            min_interval = 60.0 / max(1, REQUESTS_PER_MIN)
-            time.sleep(max(0.0, min_interval - elapsed) + random.uniform(0.1, 0.3))
-            print(f"  ► ИТОГО по строке: карточек {hits}, отзывов {total_reviews_for_row}")
+                stop.wait(JOB_POLL_INTERVAL)
+                continue
+            pos, i, fields, attempt = job
+            active[pos] = lease_name
+            limiter.wait(fields.get("site") or default_site())
+            try:
+                sup.ensure_alive()
+                with METRICS.timed("row"):
+                    rows = process_row(sup, i, n_total, fields, state)
+                METRICS.inc("rows")
+                state.journal.row(i)
+                jobs.complete(pos, rows, retry=state.deferred(i, fields))
+            except Exception as e:
+                log(f"!! Воркер {lease_name}: ошибка на строке {i} (попытка {attempt}/{JOB_MAX_ATTEMPTS}): {e}")
+                jobs.fail(pos, f"exception: {e}")
+            finally:
+                active.pop(pos, None)
     finally:
-        try: driver.quit()
-        except Exception: pass
-    if processed_rows % CHUNK_SIZE != 0:
-        save_progress(out_rows, processed_rows // CHUNK_SIZE + 1)
+        sup.quit()
+def heartbeat_loop(jobs: JobQueue, active: Dict[int, str], stop: threading.Event):
+    while not stop.wait(JOB_VISIBILITY_TIMEOUT / 3):
+        for pos, lease_name in list(active.items()):
+            try: jobs.touch(pos, lease_name)
+            except sqlite3.Error as e: log(f"!! Продление аренды {pos}: {e}")
+def coordinator_main():
+    runs = input_runs()
+    todo: List[Tuple[int, Any, Dict[str, Any]]] = []
+    for run in runs:
+        reader = open_input(run.excel)
+        if reader is None: return
+        run.offset = len(todo)
+        todo += [(run.offset + pos, i, read_row(values, run.site)) for pos, (i, values) in enumerate(reader)]
+        run.n_total = len(todo) - run.offset
+        print(f"{run.excel}: строк {run.n_total}")
+    jobs = JobQueue(JOB_QUEUE_DB)
+    source = json.dumps([[os.path.abspath(run.excel), run.site] for run in runs], ensure_ascii=False)
+    try:
+        added = jobs.enqueue(todo, source)
+    except ValueError as e:
+        raise SystemExit(f"!! Очередь {JOB_QUEUE_DB}: {e}. Укажите другую очередь (--queue PATH) или удалите файл.")
+    print(f"Очередь {JOB_QUEUE_DB}: добавлено задач {added}, всего строк {len(todo)}")
+    print("Запустите воркеры: python scrape_gis.py worker [--name NAME]")
+    last = None
+    while True:
+        jobs.release_retries()
+        counts = jobs.counts()
+        if counts != last:
+            print(f"  задачи: {', '.join(f'{k} {v}' for k, v in sorted(counts.items()))}", flush=True)
+            last = counts
+        if not counts.get("queued") and not counts.get("leased") and not counts.get("retry"):
+            break
+        time.sleep(JOB_POLL_INTERVAL)
+    for run in runs:
+        run.open_sink()
+    k = 0
+    for pos, i, fields, status, rows, error in jobs.results():
+        if pos >= len(todo): continue
+        while k + 1 < len(runs) and pos >= runs[k + 1].offset:
+            k += 1
+        runs[k].add(pos - runs[k].offset,
+                    rows if status == "done" else [error_row(i, fields, None, None, f"job {status}: {error}")])
+    for run in runs:
+        run.finish()
+def worker_main(name: Optional[str]):
+    jobs = JobQueue(JOB_QUEUE_DB)
+    METRICS.open(METRICS_PATH)
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+    n_workers = max(1, WORKERS)
+    cleanup_temp_profiles()
+    if name:
+        workdir = None
+        profiles = [f"{PROFILE_DIR}-{name}-w{wid}" for wid in range(n_workers)]
+        base, ext = os.path.splitext(JOURNAL_PATH)
+        journal_path = f"{base}-{name}{ext}"
+    else:
+        name = f"{socket.gethostname()}-{os.getpid()}"
+        workdir = tempfile.mkdtemp(prefix="2gis-worker-")
+        profiles = [os.path.join(workdir, f"profile-w{wid}") for wid in range(n_workers)]
+        journal_path = os.path.join(workdir, "journal.jsonl")
+    source = f"queue:{os.path.abspath(JOB_QUEUE_DB)}#{jobs.queue_id}"
+    resume = journal_source(journal_path) == source
+    if not resume and os.path.exists(journal_path):
+        print(f"Журнал {journal_path} относится к другой очереди — начинаем заново")
+    journal = Journal(journal_path, resume, source)
+    state = RunState(journal)
+    limiter = SharedRateLimiter(jobs)
+    n_total = sum(jobs.counts().values())
+    active: Dict[int, str] = {}
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=queue_worker, name=f"gis-worker-{wid}", daemon=True,
+                         args=(wid, name, profiles[wid], n_total, jobs, limiter, state, active, stop))
+        for wid in range(n_workers)
+    ]
+    beat = threading.Thread(target=heartbeat_loop, name="gis-heartbeat", daemon=True, args=(jobs, active, stop))
+    print(f"Воркер {name}: очередь {JOB_QUEUE_DB}, браузеров {n_workers}")
+    beat.start()
+    for t in threads: t.start()
+    try:
+        for t in threads: t.join()
+        retry_worker_cards(name, jobs, limiter, state, active)
+    finally:
+        stop.set()
+        for t in threads: t.join(timeout=60)
+        journal.close()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    METRICS.report()
+    print(f"Воркер {name}: очередь пуста ({', '.join(f'{k} {v}' for k, v in sorted(jobs.counts().items()))})")
+@contextmanager
+def retry_strategy():
+    global REVIEWS_ENGINE, GROWTH_WAIT_TIMEOUT, PER_CARD_HARD_TIMEOUT, STAGNATION_ROUNDS, DEBUG_SAMPLE_RATE
+    global SMALL_CARD_REVIEWS, SECONDS_PER_REVIEW
+    saved = (REVIEWS_ENGINE, GROWTH_WAIT_TIMEOUT, PER_CARD_HARD_TIMEOUT, STAGNATION_ROUNDS, DEBUG_SAMPLE_RATE,
+             SMALL_CARD_REVIEWS, SECONDS_PER_REVIEW)
+    REVIEWS_ENGINE = "api"
+    GROWTH_WAIT_TIMEOUT *= RETRY_WAIT_FACTOR
+    PER_CARD_HARD_TIMEOUT *= RETRY_WAIT_FACTOR
+    SECONDS_PER_REVIEW *= RETRY_WAIT_FACTOR
+    STAGNATION_ROUNDS += 2
+    SMALL_CARD_REVIEWS = 0
+    DEBUG_SAMPLE_RATE = 1.0
+    try:
+        yield
+    finally:
+        (REVIEWS_ENGINE, GROWTH_WAIT_TIMEOUT, PER_CARD_HARD_TIMEOUT, STAGNATION_ROUNDS, DEBUG_SAMPLE_RATE,
+         SMALL_CARD_REVIEWS, SECONDS_PER_REVIEW) = saved
+@timed("retry_pass")
+def retry_deferred(items: List[Tuple[str, Any, RunState, Tuple[Any, Dict[str, Any], str, List[Dict[str, Any]]]]],
+                   save: Callable[[Any, RunState, Any, str, List[Dict[str, Any]], List[Dict[str, Any]]], None],
+                   wait: Optional[Callable[[str], None]] = None):
+    sched = DomainScheduler()
+    for domain, key, state, item in items:
+        sched.put(domain, (key, state, item))
+    if not items: return
+    left = budget_left()
+    if left is not None and left <= 0:
+        print(f"\nБюджет времени исчерпан — повторный проход пропущен (карточек {len(items)})")
+        return
+    print(f"\n=== Повторный проход: карточек {len(items)} (новая сессия, API, ожидания ×{RETRY_WAIT_FACTOR:g}) ===")
+    workdir = tempfile.mkdtemp(prefix="2gis-retry-")
+    sup = DriverSupervisor(os.path.join(workdir, "profile"), "повтор")
+    try:
+        sup.start()
+    except Exception as e:
+        log(f"!! Повторный проход: браузер не запустился: {e}")
+        shutil.rmtree(workdir, ignore_errors=True)
+        return
+    try:
+        with retry_strategy():
+            while True:
+                got = sched.get()
+                if got is None:
+                    break
+                delay, (key, state, (i, fields, url, rows)) = got
+                left = budget_left()
+                if left is not None and left <= 0:
+                    print("  Бюджет времени исчерпан — стоп")
+                    break
+                if wait:
+                    wait(fields.get("site") or default_site())
+                elif delay:
+                    pause(delay, "rate_limit")
+                sup.ensure_alive()
+                print(f"  ↻ строка {i}: {url} (было отзывов: {sum(1 for r in rows if not r.get('error'))})")
+                try:
+                    status, final_url, card_rows, n_reviews = scrape_card(sup.driver, i, fields, url, 0, state)
+                except Exception as e:
+                    log(f"    ! ошибка на карточке: {type(e).__name__}: {(str(e).splitlines() or [''])[0]}")
+                    continue
+                have = {r.get("review_id") for r in rows} | {r.get("review_text") for r in rows if r.get("review_text")}
+                new = [r for r in card_rows if not r.get("error")
+                       and r.get("review_id") not in have and r.get("review_text") not in have]
+                if new:
+                    save(key, state, i, url, rows, new)
+                    METRICS.inc("retry_reviews", len(new))
+                    METRICS.inc("reviews", len(new))
+                print(f"    новых отзывов: {len(new)}")
+                sup.card_done()
+    finally:
+        sup.quit()
+        shutil.rmtree(workdir, ignore_errors=True)
+def retry_cards(runs: List["InputRun"]):
+    def save(run: "InputRun", state: RunState, i, url: str, rows: List[Dict[str, Any]], new: List[Dict[str, Any]]):
+        run.sink.write(new)
+        state.journal.card(i, url, [r for r in rows if not r.get("error")] + new)
+    retry_deferred([(run.domain, run, run.state, item) for run in runs for item in run.state.retries], save)
+def retry_worker_cards(name: str, jobs: JobQueue, limiter: SharedRateLimiter, state: RunState, active: Dict[int, str]):
+    waiting = jobs.retry_jobs(name)
+    items = []
+    for item in state.retries:
+        i, fields = item[0], item[1]
+        job = waiting.get((json.dumps(i), json.dumps(fields, ensure_ascii=False)))
+        if job is None: continue
+        active[job[0]] = job[1]
+        items.append((site_domain(fields.get("site") or default_site()), job[0], state, item))
+    added: Dict[int, List[Dict[str, Any]]] = {}
+    def save(pos: int, state: RunState, i, url: str, rows: List[Dict[str, Any]], new: List[Dict[str, Any]]):
+        added.setdefault(pos, []).extend(new)
+        state.journal.card(i, url, [r for r in rows if not r.get("error")] + new)
+    try:
+        retry_deferred(items, save, limiter.wait)
+    finally:
+        for pos, _ in waiting.values():
+            jobs.finish_retry(pos, added.pop(pos, []))
+            active.pop(pos, None)
+def tagged_path(path: str, tag: str) -> str:
+    if not tag: return path
+    base, ext = os.path.splitext(path)
+    return f"{base}_{tag}{ext}"
+class InputRun:
+    def __init__(self, k: int, excel: str, site: str, tag: str):
+        self.k = k
+        self.excel = excel
+        self.site = site.rstrip("/")
+        self.domain = site_domain(self.site)
+        self.tag = tag
+        self.progress = tagged_path(OUT_PROGRESS, tag)
+        self.out_dir = os.path.join(OUT_DIR, tag) if tag else OUT_DIR
+        self.clean = tagged_path(OUT_CLEAN, tag)
+        self.pending: Dict[int, List[Dict[str, Any]]] = {}
+        self.processed = 0
+    def load(self) -> bool:
+        self.reader = open_input(self.excel)
+        if self.reader is None: return False
+        self.n_total = 0
+        self.journal = Journal(tagged_path(JOURNAL_PATH, self.tag), RESUME, self.excel)
+        self.state = RunState(self.journal)
+        self.open_sink()
+        return True
+    def open_sink(self):
+        self.sink = ProgressSink(self.progress, self.out_dir, tagged_path(OUT_PARQUET, self.tag) if OUT_PARQUET else None)
+    def add(self, pos: int, rows: List[Dict[str, Any]]):
+        self.pending[pos] = rows
+        while self.processed in self.pending:
+            self.sink.write(self.pending.pop(self.processed))
+            self.processed += 1
+            if self.processed % CHUNK_SIZE == 0:
+                self.sink.end_chunk(self.processed // CHUNK_SIZE)
+    def finish(self):
+        if self.processed < self.n_total:
+            print(f"!! {self.excel}: обработано строк по порядку: {self.processed}/{self.n_total}")
+            for pos in sorted(self.pending):
+                self.sink.write(self.pending.pop(pos))
+                self.processed += 1
+        self.sink.close((self.processed + CHUNK_SIZE - 1) // CHUNK_SIZE)
+        if POSTPROCESS:
+            run_postprocess([self.progress], self.clean)
+        print(f"\nГотово ({self.site}). Всего строк в прогрессе: {self.sink.count} → {self.progress}")
+        print(f"Частями см. в каталоге: {self.out_dir}\\2gis_reviews_chunk_*.csv")
+def input_runs() -> List[InputRun]:
+    specs = INPUTS or [(EXCEL_PATH, default_site())]
+    tags: List[str] = []
+    for excel, site in specs:
+        tag = site.rstrip("/").rsplit("/", 1)[-1] if len(specs) > 1 else ""
+        if tag in tags:
+            tag = f"{tag}_{len(tags)}"
+        tags.append(tag)
+    part = shard_tag()
+    tags = ["_".join(t for t in (tag, part) if t) for tag in tags]
+    return [InputRun(k, excel, site, tag) for k, ((excel, site), tag) in enumerate(zip(specs, tags))]
+def main():
+    global _deadline
+    print("Файл загружен, вызываю main() ...", flush=True)
+    runs = [run for run in input_runs() if run.load()]
+    if not runs: return
+    METRICS.open(METRICS_PATH)
+    if METRICS_PORT:
+        METRICS.serve(METRICS_PORT)
+    cleanup_temp_profiles()
+    _deadline = time.time() + TIME_BUDGET_MIN * 60 if TIME_BUDGET_MIN else None
+    sched = DomainScheduler()
+    results: "queue.Queue" = queue.Queue()
+    tasks = []
+    for run in runs:
+        for pos, (i, values) in enumerate(run.reader):
+            run.n_total += 1
+            if i in run.journal.done_rows:
+                results.put(("row", (run.k, pos), run.journal.done_rows[i]))
+            else:
+                tasks.append((run, pos, i, values))
+        print(f"{run.excel}: строк {run.n_total}")
+    if tasks:
+        tasks = plan_rows(tasks, min(max(1, WORKERS), len(tasks)))
+    for task in tasks:
+        sched.put(task[0].domain, task)
+    n_todo = len(tasks)
+    n_total = sum(run.n_total for run in runs)
+    if RESUME:
+        print(f"Продолжение по журналу: пропущено строк {n_total - n_todo}, осталось {n_todo}")
+    if len(runs) > 1:
+        print("Города: " + ", ".join(f"{run.site} ({run.n_total}, {domain_rate(run.domain):g}/мин)" for run in runs))
+    n_workers = min(max(1, WORKERS), n_todo)
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=worker_loop, name=f"gis-worker-{wid}", daemon=True,
+                         args=(wid, sched, results, stop))
+        for wid in range(n_workers)
+    ]
+    for t in threads: t.start()
+    print(f"Запущено воркеров: {n_workers}\n")
+    by_k = {run.k: run for run in runs}
+    received = 0
+    alive = n_workers
+    try:
+        while received < n_total:
+            if not alive and results.empty():
+                break
+            kind, key, rows = results.get()
+            if kind == "exit":
+                alive -= 1
+                continue
+            k, pos = key
+            by_k[k].add(pos, rows)
+            received += 1
+    finally:
+        stop.set()
+        for t in threads: t.join(timeout=60)
+    try:
+        retry_cards(runs)
+    finally:
+        for run in runs: run.journal.close()
+    for run in runs:
+        run.finish()
+    if REPORT_PATH:
+        run_report([run.progress for run in runs])
+    left = budget_left()
+    if left is not None and left <= 0 and received < n_total:
+        print(f"Бюджет времени {TIME_BUDGET_MIN:g} мин исчерпан: не обработано строк {n_total - received}. "
+              "Продолжить: python scrape_gis.py scrape --resume")
+    METRICS.report()
+def resolve_main(out_path: str):
+    specs = INPUTS or [(EXCEL_PATH, default_site())]
+    cache = get_resolve_cache()
+    sup = DriverSupervisor(PROFILE_DIR, attach=True)
+    buckets: Dict[str, TokenBucket] = {}
+    n_rows = n_cached = 0
+    try:
+        with open(out_path, "w", newline="", encoding="utf-8-sig") as f:
+            w = csv.writer(f)
+            w.writerow(["input", "src_row_index", "firm_id", "org_name", "cards"])
+            for excel, site in specs:
+                reader = open_input(excel)
+                if reader is None: continue
+                domain = site_domain(site)
+                for i, values in reader:
+                    fields = read_row(values, site.rstrip("/"))
+                    key = row_cache_key(fields)
+                    cards = cache.get("row_cache", key) if cache else None
+                    if cards is None:
+                        if sup.driver is None:
+                            sup.start()
+                        sup.ensure_alive()
+                        bucket = buckets.setdefault(domain, TokenBucket(domain_rate(domain), DOMAIN_BURST))
+                        pause(bucket.take(time.time()), "rate_limit")
+                        print(f"[{i+1}] ► {fields['name'] or fields['id_pref'] or fields['phones']}")
+                        cards = resolve_candidates(sup.driver, fields)
+                        if cache and cards:
+                            cache.put("row_cache", key, cards)
+                    else:
+                        n_cached += 1
+                    w.writerow([excel, i, fields["id_pref"], fields["name"], " ".join(cards)])
+                    n_rows += 1
+    finally:
+        sup.quit()
+    print(f"Карточки найдены для строк: {n_rows} (из кэша {n_cached}) → {out_path}")
+def merge_main(paths: List[str], out_path: str):
+    raw = read_outputs(paths)
+    keyed = raw["review_id"].notna()
+    df = pd.concat([raw[keyed].drop_duplicates(["two_gis_url", "review_id"]), raw[~keyed].drop_duplicates()])
+    df = df.sort_index(kind="stable")
+    if out_path.endswith(".parquet"):
+        df.to_parquet(out_path, index=False)
+    else:
+        df.to_csv(out_path, index=False, encoding="utf-8-sig")
+    print(f"Объединено: файлов {len(paths)}, строк {len(raw)} → {len(df)} → {out_path}")
+def table_counts(path: str, tables: List[str]) -> Dict[str, int]:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        out = {}
+        for table in tables:
+            try: out[table] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            except sqlite3.OperationalError: pass
+        return out
+    finally:
+        conn.close()
+def stats_main(paths: List[str]):
+    for path in paths or [OUT_PROGRESS]:
+        if not os.path.exists(path):
+            print(f"{path}: нет файла")
+            continue
+        rows, cards, reviews, errors = set(), set(), 0, 0
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for r in csv.DictReader(f):
+                rows.add(r.get("src_row_index"))
+                if r.get("error"):
+                    errors += 1
+                else:
+                    reviews += 1
+                    cards.add(r.get("two_gis_url"))
+        print(f"{path}: строк входа {len(rows)}, карточек {len(cards)}, отзывов {reviews}, строк с ошибкой {errors}")
+    if os.path.exists(JOURNAL_PATH):
+        kinds: Dict[str, int] = {}
+        with open(JOURNAL_PATH, encoding="utf-8") as f:
+            for line in f:
+                try: kind = json.loads(line).get("t")
+                except ValueError: continue
+                kinds[kind] = kinds.get(kind, 0) + 1
+        print(f"{JOURNAL_PATH}: готово строк {kinds.get('row', 0)}, карточек {kinds.get('card', 0)}")
+    if JOB_QUEUE_DB and os.path.exists(JOB_QUEUE_DB):
+        conn = sqlite3.connect(f"file:{JOB_QUEUE_DB}?mode=ro", uri=True)
+        try:
+            counts = dict(conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        except sqlite3.OperationalError:
+            counts = {}
+        finally:
+            conn.close()
+        print(f"{JOB_QUEUE_DB}: {', '.join(f'{k} {v}' for k, v in sorted(counts.items())) or 'пусто'}")
+    for path in dict.fromkeys(p for p in (RESOLVE_CACHE_DB, REVIEW_INDEX_DB) if p and os.path.exists(p)):
+        counts = table_counts(path, ["search_cache", "row_cache", "hint_cache", "card_index", "review_index"])
+        print(f"{path}: {', '.join(f'{k} {v}' for k, v in counts.items())}")
+def parse_shard(v: str) -> Tuple[int, int]:
+    m = re.fullmatch(r"(\d+)/(\d+)", v)
+    if not m or int(m.group(1)) >= int(m.group(2)):
+        raise argparse.ArgumentTypeError("ожидается K/N, 0 <= K < N")
+    return int(m.group(1)), int(m.group(2))
+def parse_rows(v: str) -> Tuple[int, Optional[int]]:
+    m = re.fullmatch(r"(\d*):(\d*)", v)
+    if not m:
+        raise argparse.ArgumentTypeError("ожидается START:END")
+    return int(m.group(1) or 0), int(m.group(2)) if m.group(2) else None
+def parse_input(v: str) -> Tuple[str, str]:
+    spec = tuple(v.rsplit("=", 1))
+    if len(spec) != 2:
+        raise argparse.ArgumentTypeError("ожидается EXCEL=URL, напр. Алматы.xlsx=https://2gis.kz/almaty")
+    return spec
+def parse_on_off(v: str) -> bool:
+    if v not in ("on", "off"):
+        raise argparse.ArgumentTypeError("ожидается on или off")
+    return v == "on"
+def load_config(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        cfg = json.load(f)
+    if not isinstance(cfg, dict):
+        raise ValueError("ожидается JSON-объект")
+    unknown = [k for k in cfg if k not in CONFIG_KEYS]
+    if unknown:
+        raise ValueError(f"неизвестные настройки: {', '.join(unknown)}")
+    if cfg.get("INPUTS"):
+        cfg["INPUTS"] = [tuple(spec) for spec in cfg["INPUTS"]]
+    for k in ("SHARD", "ROW_RANGE"):
+        if cfg.get(k) is not None:
+            cfg[k] = tuple(cfg[k])
+    return cfg
+def build_parser() -> argparse.ArgumentParser:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--config", help="JSON с настройками: имена констант скрипта и значения, напр. {\"WORKERS\": 2}")
+    inputs = argparse.ArgumentParser(add_help=False)
+    inputs.add_argument("--excel", dest="EXCEL_PATH", metavar="PATH", help=f"входной файл .xlsx/.csv/.parquet (по умолчанию {EXCEL_PATH})")
+    inputs.add_argument("--input", dest="INPUTS", action="append", type=parse_input, metavar="EXCEL=URL",
+                        help="пакетный режим: Excel и город 2ГИС, напр. Алматы.xlsx=https://2gis.kz/almaty (можно повторять)")
+    inputs.add_argument("--shard", dest="SHARD", type=parse_shard, metavar="K/N", help="обработать только K-ю из N частей входа (по хэшу id, K от 0)")
+    inputs.add_argument("--rows", dest="ROW_RANGE", type=parse_rows, metavar="START:END", help="обработать только строки входа с START по END-1 (с 0)")
+    browser = argparse.ArgumentParser(add_help=False)
+    browser.add_argument("--workers", dest="WORKERS", type=int, help="число параллельных браузеров")
+    browser.add_argument("--headless", dest="HEADLESS", action="store_const", const=True, help="Chrome без окна")
+    browser.add_argument("--light", dest="LIGHT_MODE", type=parse_on_off, metavar="on|off", help="блокировать картинки, шрифты, тайлы карты и аналитику")
+    browser.add_argument("--debugger-address", dest="DEBUGGER_ADDRESS", metavar="HOST:PORT",
+                         help="подключиться к уже запущенному Chrome (--remote-debugging-port) вместо запуска нового")
+    browser.add_argument("--metrics-port", dest="METRICS_PORT", type=int, help="порт для метрик в формате Prometheus (/metrics)")
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument("--queue", dest="JOB_QUEUE_DB", metavar="PATH", help=f"путь к SQLite-очереди (по умолчанию {JOB_QUEUE_DB})")
+    ap = argparse.ArgumentParser(description="Парсер отзывов 2ГИС")
+    sub = ap.add_subparsers(dest="command", metavar="команда")
+    p = sub.add_parser("scrape", parents=[common, inputs, browser], help="собрать отзывы (по умолчанию)")
+    p.add_argument("--resume", dest="RESUME", action="store_const", const=True, help=f"продолжить прерванный запуск по журналу {JOURNAL_PATH}")
+    p.add_argument("--incremental", dest="INCREMENTAL", action="store_const", const=True,
+                   help="собирать только отзывы, которых нет в индексе прошлых запусков")
+    p.add_argument("--time-budget", dest="TIME_BUDGET_MIN", type=float, metavar="MIN",
+                   help="общий бюджет времени в минутах: после него новые строки не начинаются (продолжить можно с --resume)")
+    p = sub.add_parser("resolve-only", parents=[common, inputs, browser], help="только найти карточки строк и заполнить кэш, без отзывов")
+    p.add_argument("--out", default="2gis_resolved.csv", help="CSV со списком карточек по строкам (по умолчанию %(default)s)")
+    sub.add_parser("coordinator", parents=[common, inputs, jobs], help="поставить строки в очередь и собрать результаты воркеров")
+    p = sub.add_parser("worker", parents=[common, browser, jobs], help="брать задачи из очереди и обрабатывать их")
+    p.add_argument("--name", help="постоянное имя воркера (свой профиль Chrome и журнал)")
+    p.add_argument("--incremental", dest="INCREMENTAL", action="store_const", const=True,
+                   help="собирать только отзывы, которых нет в индексе прошлых запусков")
+    p = sub.add_parser("postprocess", parents=[common], help=f"очистка и дедупликация готовых выгрузок → {OUT_CLEAN}")
+    p.add_argument("paths", nargs="+", metavar="PATH", help="CSV/Parquet файлы или каталоги с частями")
+    p.add_argument("--out", dest="OUT_CLEAN", help=f"выходной .csv/.parquet (по умолчанию {OUT_CLEAN})")
+    p = sub.add_parser("merge", parents=[common], help="объединить выгрузки нескольких запусков без очистки")
+    p.add_argument("paths", nargs="+", metavar="PATH", help="CSV/Parquet файлы или каталоги с частями")
+    p.add_argument("--out", required=True, help="выходной .csv/.parquet")
+    p = sub.add_parser("report", parents=[common], help="recall, скорость и причины остановки по выгрузке; сравнение с baseline")
+    p.add_argument("paths", nargs="*", metavar="PATH", help=f"CSV/Parquet выгрузки или каталоги с частями (по умолчанию {OUT_PROGRESS})")
+    p.add_argument("--metrics", metavar="PATH", help=f"файл метрик запуска (по умолчанию {METRICS_PATH}, берётся последняя сводка)")
+    p.add_argument("--baseline", metavar="PATH", help=f"отчёт для сравнения (по умолчанию {REPORT_BASELINE})")
+    p.add_argument("--save-baseline", metavar="PATH", help="сохранить отчёт как новый baseline")
+    p.add_argument("--tolerance", dest="REPORT_TOLERANCE", type=float, help=f"допустимое ухудшение (доля, по умолчанию {REPORT_TOLERANCE:g})")
+    p = sub.add_parser("stats", parents=[common], help="сводка по выгрузке, журналу, очереди и кэшу")
+    p.add_argument("paths", nargs="*", metavar="PATH", help=f"CSV выгрузки (по умолчанию {OUT_PROGRESS})")
+    return ap
+LEGACY_FLAGS = {"--coordinator": "coordinator", "--worker": "worker", "--postprocess": "postprocess"}
+COMMANDS = ("scrape", "resolve-only", "coordinator", "worker", "postprocess", "merge", "report", "stats")
+CONFIG_KEYS = (
+    "EXCEL_PATH", "CITY_SLUG", "BASE_DOMAIN", "INPUTS", "SHARD", "ROW_RANGE", "OUT_PROGRESS", "OUT_DIR",
+    "OUT_PARQUET", "OUT_CLEAN", "POSTPROCESS", "JOURNAL_PATH", "RESUME", "JOB_QUEUE_DB",
+    "JOB_VISIBILITY_TIMEOUT", "JOB_MAX_ATTEMPTS", "JOB_POLL_INTERVAL", "CHUNK_SIZE", "REQUESTS_PER_MIN",
+    "DOMAIN_REQUESTS_PER_MIN", "DOMAIN_BURST", "MAX_LOAD_STEPS", "STAGNATION_ROUNDS", "PER_CARD_HARD_TIMEOUT",
+    "SMALL_CARD_REVIEWS", "HUGE_CARD_REVIEWS", "HUGE_CARD_TIMEOUT", "REVIEWS_PER_STEP", "SECONDS_PER_REVIEW",
+    "SIZE_ORDER", "SIZE_ORDER_WINDOW", "TIME_BUDGET_MIN", "WAIT_SMALL",
+    "GROWTH_WAIT_TIMEOUT", "RECYCLE_AFTER_CARDS", "RENDERER_MEM_LIMIT_MB", "HEADLESS", "PROFILE_DIR",
+    "CHROMEDRIVER_PATH", "DRIVER_CACHE_PATH", "DEBUGGER_ADDRESS", "TEMP_PROFILE_MAX_AGE_H",
+    "PAGELOAD_STRATEGY", "LIGHT_MODE", "BLOCKED_URL_PATTERNS", "VERBOSE", "RETRY_BELOW_RECALL",
+    "RETRY_WAIT_FACTOR", "DEBUG_DIR", "DEBUG_SAMPLE_RATE", "DEBUG_MAX_FILES", "METRICS_PATH", "REPORT_PATH",
+    "REPORT_BASELINE", "REPORT_TOLERANCE", "METRICS_PORT", "WORKERS", "REVIEWS_ENGINE", "REVIEWS_API_RX",
+    "API_PAGE_LIMIT", "API_MAX_PAGES", "API_TIMEOUT", "CAPTURE_NETWORK", "RESOLVE_CACHE_DB",
+    "RESOLVE_CACHE_TTL_DAYS", "EMPTY_SEARCH_TTL_H", "MAX_WEAK_CANDIDATES", "INCREMENTAL", "REVIEW_INDEX_DB",
+    "CARD_INDEX_MAX_AGE_H",
+)
+def command_index(ap: argparse.ArgumentParser, argv: List[str]) -> Optional[int]:
+    sub = next(a for a in ap._actions if isinstance(a, argparse._SubParsersAction))
+    with_value = {opt for p in sub.choices.values() for a in p._actions if a.nargs != 0 for opt in a.option_strings}
+    skip = False
+    for j, a in enumerate(argv):
+        if skip:
+            skip = False
+        elif a == "--":
+            return None
+        elif a in COMMANDS:
+            return j
+        else:
+            skip = a in with_value
+    return None
+def cli(argv: Optional[List[str]] = None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    for flag, command in LEGACY_FLAGS.items():
+        if flag in argv:
+            argv.remove(flag)
+            argv.insert(0, command)
+    argv = ["--name" if a == "--worker-name" else a for a in argv]
+    ap = build_parser()
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ("-h", "--help")):
+        j = command_index(ap, argv)
+        argv.insert(0, argv.pop(j) if j is not None else "scrape")
+    args = ap.parse_args(argv)
+    settings: Dict[str, Any] = {}
+    if args.config:
+        try:
+            settings.update(load_config(args.config))
+        except (OSError, ValueError) as e:
+            ap.error(f"--config {args.config}: {e}")
+    settings.update({k: v for k, v in vars(args).items() if k.isupper() and v is not None})
+    globals().update(settings)
+    if args.command == "postprocess":
+        run_postprocess(args.paths, OUT_CLEAN)
+    elif args.command == "merge":
+        merge_main(args.paths, args.out)
+    elif args.command == "report":
+        if run_report(args.paths or [OUT_PROGRESS], args.metrics, args.baseline, args.save_baseline):
+            raise SystemExit(1)
+    elif args.command == "stats":
+        stats_main(args.paths)
+    elif args.command == "resolve-only":
+        resolve_main(args.out)
+    elif args.command == "coordinator":
+        coordinator_main()
+    elif args.command == "worker":
+        worker_main(args.name)
     else:
-        pd.DataFrame(out_rows).to_csv(OUT_PROGRESS, index=False, encoding="utf-8-sig")
-    print(f"\nГотово. Всего строк в прогрессе: {len(out_rows)} → {OUT_PROGRESS}")
-    print(f"Частями см. в каталоге: {OUT_DIR}\\2gis_reviews_chunk_*.csv")
+        main()
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()